@@ -1,89 +1,193 @@
 #!/usr/bin/env python2
 
-import argparse, sys, os, grpc, re, json
-from time import sleep
+import argparse, sys, os, grpc, re, json, time, struct, signal, threading
+from multiprocessing.pool import ThreadPool
 
 sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'utils/'))
 
 import p4runtime_lib.helper
 from p4runtime_lib.switch import ShutdownAllSwitchConnections
 from p4runtime_lib.convert import decodeMac, decodeIPv4
-from switch_utils import printGrpcError,load_topology,run_ssc_cmd
+from switch_utils import printGrpcError,load_topology,tor_indices
+from thrift_runtime import GetThriftClient, ShutdownAllThriftClients
 
 switch_reg = re.compile(r"^s(\d+)$")
 
-def generate_register_reads(register_name, indices):
-    cmd = ""
-    for idx in indices:
-        cmd += "register_read MyIngress.%s %d\n" % (register_name, idx)
-    return cmd
-
-
-snapshot_best_hop_cmd = generate_register_reads('best_hop', [100, 101, 102,
-                                                             103, 104, 105,
-                                                             106, 107])
-
-snapshot_port_util_cmd = generate_register_reads('port_util', [0, 1, 2, 3, 4, 5, 6])
-
-process_best_hop_regex = re.compile(".*hop\[(\d+)\]\s*=\s*(\d+)")
-process_port_util_regex = re.compile(".*util\[(\d+)\]\s*=\s*(\d+)")
-
-def process_and_output(output, reg):
-    best_hops = {}
-
-    for line in output.split("\n"):
-        match = reg.search(line)
-        if match:
-            best_hops[match.group(1)] = match.group(2)
-
-    return best_hops
-
-def benchmark(mn_topo, switches, bench_switches, interval, count):
-    data = []
-    c = count
-    while c > 0:
-        snapshot = {'count': count - c, 'best_hops': {}, 'port_util': {}}
-        for switch in bench_switches:
-            out = run_ssc_cmd(switch,snapshot_best_hop_cmd, False)
-            best_hops = process_and_output(out, process_best_hop_regex)
-            snapshot['best_hops'][switch] = best_hops
-
-            out = run_ssc_cmd(switch,snapshot_port_util_cmd, False)
-            port_util = process_and_output(out, process_port_util_regex)
-            snapshot['port_util'][switch] = port_util
-
-        c -= 1
-        data.append(snapshot.copy())
-        sleep(interval)
-
-    return data
-
-def main(p4info_file_path, bmv2_file_path, topo_file_path, bench_switches, interval, count):
+# Registers that can be included in snapshots, by how their indices are
+# chosen: one slot per ToR, reported by switch number (e.g. 104 for s104), one
+# slot per port of the switch, or the non zero slots of the flowlet table.
+PER_TOR_REGISTERS = ['best_hop', 'min_path_util', 'update_time']
+PER_PORT_REGISTERS = ['port_util', 'port_util_last_updated']
+FLOWLET_REGISTERS = ['flowlet_hop', 'flowlet_time']
+REGISTERS = PER_TOR_REGISTERS + PER_PORT_REGISTERS + FLOWLET_REGISTERS
+
+DEFAULT_REGISTERS = ['best_hop', 'port_util']
+
+# Snapshot keys that differ from the register name
+SNAPSHOT_KEYS = {'best_hop': 'best_hops'}
+
+# Map from the keys used in snapshots to register indices, for every switch
+# and register. None stands for the non zero slots.
+def register_indices(mn_topo, bench_switches, registers):
+    by_tor = dict((int(switch_reg.search(tor).group(1)), idx)
+                  for tor, idx in tor_indices(mn_topo).iteritems())
+    indices = {}
+    for switch in bench_switches:
+        by_port = dict((port, port) for port, _ in mn_topo.sw_port_mapping.get(switch, []))
+        for register_name in registers:
+            if register_name in PER_TOR_REGISTERS:
+                indices[(switch, register_name)] = by_tor
+            elif register_name in PER_PORT_REGISTERS:
+                indices[(switch, register_name)] = by_port
+            else:
+                indices[(switch, register_name)] = None
+    return indices
+
+# Read a whole register in one call and pick the slots at `indices`.
+def read_register(client, register_name, indices):
+    values = client.register_read_all("MyIngress.%s" % register_name)
+    if indices is None:
+        return dict((idx, value) for idx, value in enumerate(values) if value)
+    return dict((key, values[idx]) for key, idx in indices.iteritems())
+
+SNAPSHOT_FORMATS = ['json', 'ndjson', 'binary']
+
+# Number of snapshots written between two flushes of the output
+FLUSH_EVERY = 10
+
+class SnapshotSink(object):
+    """
+    Writes snapshots as they are taken, so that memory use does not grow with
+    the length of a run and a crash only loses the snapshots not yet flushed.
+    'json' streams a JSON array, 'ndjson' writes one compact JSON object per
+    line and 'binary' writes each compact JSON object after its length as a
+    4 byte big endian integer.
+    """
+
+    def __init__(self, out, snapshot_format='json', flush_every=FLUSH_EVERY):
+        self.out = out
+        self.format = snapshot_format
+        self.flush_every = max(1, flush_every)
+        self.count = 0
+        if self.format == 'json':
+            self.out.write('[')
+
+    def write(self, snapshot):
+        record = json.dumps(snapshot, sort_keys=True, separators=(',', ':'))
+        if self.format == 'json':
+            self.out.write('\n' if self.count == 0 else ',\n')
+            self.out.write(record)
+        elif self.format == 'ndjson':
+            self.out.write(record + '\n')
+        else:
+            self.out.write(struct.pack('!I', len(record)) + record)
+        self.count += 1
+        if self.count % self.flush_every == 0:
+            self.out.flush()
+
+    def close(self):
+        if self.format == 'json':
+            self.out.write('\n]\n')
+        self.out.flush()
+
+# Read the registers of one switch. Returns the values of each register and
+# the wall clock time before and after the reads. With `dp_time`, also returns
+# the data plane time of the switch: the most recent port_util_last_updated.
+def snapshot_switch(switch, registers, indices, dp_time):
+    client = GetThriftClient(switch)
+    times = {'start': time.time()}
+    values = {}
+    try:
+        for register_name in registers:
+            values[register_name] = read_register(client, register_name,
+                                                  indices[(switch, register_name)])
+        if dp_time:
+            times['dp_time'] = max(client.register_read_all(
+                "MyIngress.port_util_last_updated") or [0])
+    except Exception as e:
+        times['error'] = repr(e)
+    times['end'] = time.time()
+    return (values, times)
+
+# Take `count` snapshots, or snapshots until `stop` is set if `count` is 0, one
+# every `interval` seconds, and write them to `sink`. The switches of a
+# snapshot are read concurrently by `jobs` threads. Each snapshot records when
+# every switch was read and its skew, the time between the first and the last
+# read.
+def benchmark(mn_topo, switches, bench_switches, interval, count, registers,
+              jobs, sink, stop, dp_time=False):
+    indices = register_indices(mn_topo, bench_switches, registers)
+    # Connect beforehand so that the first snapshot is not skewed.
+    for switch in bench_switches:
+        GetThriftClient(switch)
+    pool = ThreadPool(max(1, min(jobs or len(bench_switches), len(bench_switches))))
+    try:
+        next_time = time.time()
+        c = 0
+        while (count == 0 or c < count) and not stop.is_set():
+            results = pool.map(
+                lambda sw: snapshot_switch(sw, registers, indices, dp_time),
+                bench_switches)
+            snapshot = {'count': c, 'times': {}}
+            for register_name in registers:
+                snapshot[SNAPSHOT_KEYS.get(register_name, register_name)] = {}
+            for switch, (values, times) in zip(bench_switches, results):
+                snapshot['times'][switch] = times
+                for register_name, value in values.iteritems():
+                    key = SNAPSHOT_KEYS.get(register_name, register_name)
+                    snapshot[key][switch] = value
+            snapshot['start'] = min(t['start'] for t in snapshot['times'].values())
+            snapshot['end'] = max(t['end'] for t in snapshot['times'].values())
+            snapshot['skew'] = snapshot['end'] - snapshot['start']
+            sink.write(snapshot)
+            c += 1
+
+            next_time += interval
+            delay = next_time - time.time()
+            if delay > 0:
+                stop.wait(delay)
+    finally:
+        pool.terminate()
+
+def main(p4info_file_path, bmv2_file_path, topo_file_path, bench_switches, interval, count,
+         registers, jobs, dp_time, output, snapshot_format, flush_every):
     # Instantiate a P4Runtime helper from the p4info file
     p4info_helper = p4runtime_lib.helper.P4InfoHelper(p4info_file_path)
 
     try:
-        # Load the topology from the JSON file
+        # Load the topology from the JSON file. Snapshots are read over thrift,
+        # so no P4Runtime connection is opened.
         switches, mn_topo = load_topology(topo_file_path)
 
-        # Establish a P4 Runtime connection to each switch
-        for bmv2_switch in switches.values():
-            bmv2_switch.MasterArbitrationUpdate()
-            print "Established as controller for %s" % bmv2_switch.name
-
         bs = bench_switches
         if len(bs) == 0:
             bs = mn_topo.switches()
 
-        data = benchmark(mn_topo, switches, bs, interval, count)
-        print json.dumps(data, sort_keys=True, indent=2, separators=(',', ': '))
+        # Stop after the current snapshot on SIGINT or SIGTERM.
+        stop = threading.Event()
+        def on_signal(signum, frame):
+            stop.set()
+        signal.signal(signal.SIGINT, on_signal)
+        signal.signal(signal.SIGTERM, on_signal)
+
+        out = open(output, 'wb') if output is not None else sys.stdout
+        sink = SnapshotSink(out, snapshot_format, flush_every)
+        try:
+            benchmark(mn_topo, switches, bs, interval, count, registers, jobs,
+                      sink, stop, dp_time)
+        finally:
+            sink.close()
+            if output is not None:
+                out.close()
+        print >> sys.stderr, "Wrote %d snapshots" % sink.count
 
     except KeyboardInterrupt:
-        print " Shutting down."
+        print >> sys.stderr, " Shutting down."
     except grpc.RpcError as e:
         printGrpcError(e)
 
     ShutdownAllSwitchConnections()
+    ShutdownAllThriftClients()
 
 def get_args():
     parser = argparse.ArgumentParser()
@@ -91,8 +195,18 @@ def get_args():
                         nargs='+', required=False, default=[])
     parser.add_argument('-t', '--snap-interval', help='Snapshot interval in seconds',
                         type=float, required=False, default=1)
-    parser.add_argument('-n', '--snap-count', help='Number of snapshots to take',
+    parser.add_argument('-n', '--snap-count', help='Number of snapshots to take, 0 to '
+                        'take snapshots until interrupted',
                         type=int, required=True)
+    parser.add_argument('-o', '--output', help='File to write snapshots to, instead '
+                        'of the standard output',
+                        type=str, action="store", required=False, default=None)
+    parser.add_argument('-f', '--format', help='Format of the snapshots',
+                        type=str, action="store", required=False,
+                        choices=SNAPSHOT_FORMATS, default='json')
+    parser.add_argument('--flush-every', help='Number of snapshots written between '
+                        'two flushes of the output',
+                        type=int, required=False, default=FLUSH_EVERY)
     parser.add_argument('--p4info', help='p4info proto in text format from p4c',
                         type=str, action="store", required=False,
                         default='./build/switch.p4info')
@@ -102,6 +216,15 @@ def get_args():
     parser.add_argument('--topo', help='Topology file',
                         type=str, action="store", required=False,
                         default='topology.json')
+    parser.add_argument('-r', '--registers', help='Registers to snapshot',
+                        nargs='+', required=False, choices=REGISTERS,
+                        default=DEFAULT_REGISTERS)
+    parser.add_argument('-j', '--jobs', help='Number of switches read concurrently, '
+                        'all of them by default',
+                        type=int, required=False, default=0)
+    parser.add_argument('--dp-time', help='Also record the data plane time of each '
+                        'switch (latest port_util_last_updated, in microseconds)',
+                        action='store_true', required=False, default=False)
     return parser, parser.parse_args()
 
 
@@ -122,4 +245,5 @@ if __name__ == '__main__':
         parser.exit(1)
 
     main(args.p4info, args.bmv2_json, args.topo, args.switches, args.snap_interval,
-         args.snap_count)
+         args.snap_count, args.registers, args.jobs, args.dp_time, args.output,
+         args.format, args.flush_every)
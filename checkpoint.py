@@ -0,0 +1,163 @@
+#!/usr/bin/env python2
+#
+# Saves the HULA state learned by the switches to a checkpoint file and
+# restores it, so that experiments can resume from a warmed up fabric instead
+# of waiting for probes and flowlets to converge again.
+#
+#   ./checkpoint.py save warm.ckpt
+#   ./checkpoint.py restore warm.ckpt --rebase
+#
+# A checkpoint is gzipped JSON. Every register is stored as a list of
+# [value, count] runs since most of the array is usually zero.
+#
+import argparse, sys, os, json, gzip, time
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'utils/'))
+
+from switch_utils import load_topology
+from switch_utils import run_concurrently,printSwitchReport,PROVISION_JOBS
+from thrift_runtime import GetThriftClient, ShutdownAllThriftClients
+
+CHECKPOINT_VERSION = 1
+
+# The registers of MyIngress holding learned state
+REGISTERS = ['best_hop', 'min_path_util', 'update_time', 'port_util',
+             'port_util_last_updated', 'flowlet_hop', 'flowlet_time']
+
+# Registers holding ingress_global_timestamp values. The clock of a switch
+# starts at 0 when it starts, so they may need to be rebased on restore.
+TIME_REGISTERS = ['update_time', 'port_util_last_updated', 'flowlet_time']
+
+def run_length_encode(values):
+    runs = []
+    for value in values:
+        if runs and runs[-1][0] == value:
+            runs[-1][1] += 1
+        else:
+            runs.append([value, 1])
+    return runs
+
+def save_switch(switch):
+    client = GetThriftClient(switch)
+    return dict((register_name,
+                 run_length_encode(client.register_read_all("MyIngress.%s" % register_name)))
+                for register_name in REGISTERS)
+
+# Current data plane time of a switch, as far as its registers tell: the most
+# recent port_util_last_updated, 0 if no packet came in since it started.
+def data_plane_time(client):
+    return max(client.register_read_all("MyIngress.port_util_last_updated") or [0])
+
+# Shift the non zero timestamps of a switch so that the most recent one
+# becomes `time_base`. Older timestamps keep their age, and those older than
+# `time_base` itself are clamped at 0, i.e. never updated.
+def rebase_times(registers, time_base):
+    newest = max([value for name in TIME_REGISTERS if name in registers
+                  for value, _ in registers[name]] or [0])
+    for name in TIME_REGISTERS:
+        if name not in registers:
+            continue
+        registers[name] = [[max(0, value - newest + time_base) if value else 0, count]
+                           for value, count in registers[name]]
+
+# With `rebase`, timestamps are rebased onto the current data plane time of
+# the switch, read before anything is written, unless `time_base` is given.
+def restore_switch(switch, registers, time_base=None, rebase=False):
+    client = GetThriftClient(switch)
+    if rebase and time_base is None:
+        time_base = data_plane_time(client)
+    if time_base is not None:
+        rebase_times(registers, time_base)
+    writes = 0
+    for register_name, runs in registers.iteritems():
+        index = 0
+        for value, count in runs:
+            if count == 1:
+                client.register_write("MyIngress.%s" % register_name, index, value)
+            else:
+                client.register_write_range("MyIngress.%s" % register_name,
+                                            index, index + count - 1, value)
+            index += count
+            writes += 1
+    return writes
+
+def save(switch_names, checkpoint_path, jobs):
+    report = run_concurrently(switch_names, save_switch, jobs)
+    printSwitchReport(report)
+    checkpoint = {
+        'version': CHECKPOINT_VERSION,
+        'saved_at': time.time(),
+        'switches': dict((sw, result) for sw, (_, error, result) in report.iteritems()
+                         if error is None)
+    }
+    with gzip.open(checkpoint_path, 'wb') as f:
+        json.dump(checkpoint, f, separators=(',', ':'))
+    print "Saved %d switches to %s" % (len(checkpoint['switches']), checkpoint_path)
+
+def restore(switch_names, checkpoint_path, jobs, time_base, rebase):
+    with gzip.open(checkpoint_path, 'rb') as f:
+        checkpoint = json.load(f)
+    if checkpoint.get('version') != CHECKPOINT_VERSION:
+        print "Unsupported checkpoint version %s" % checkpoint.get('version')
+        return
+    saved = checkpoint['switches']
+    missing = [sw for sw in switch_names if sw not in saved]
+    if missing:
+        print "Not in the checkpoint, skipping: %s" % ", ".join(missing)
+
+    def restore_one(sw):
+        return restore_switch(sw, saved[sw], time_base, rebase)
+
+    report = run_concurrently([sw for sw in switch_names if sw in saved],
+                              restore_one, jobs)
+    printSwitchReport(report)
+
+def main(topo_file_path, command, checkpoint_path, switch_names, jobs, time_base,
+         rebase):
+    try:
+        switches, mn_topo = load_topology(topo_file_path)
+        if not switch_names:
+            switch_names = mn_topo.switches()
+        if command == 'save':
+            save(switch_names, checkpoint_path, jobs)
+        else:
+            restore(switch_names, checkpoint_path, jobs, time_base, rebase)
+
+    except KeyboardInterrupt:
+        print " Shutting down."
+
+    ShutdownAllThriftClients()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Checkpoint of the HULA registers')
+    parser.add_argument('command', choices=['save', 'restore'])
+    parser.add_argument('checkpoint', help='Checkpoint file', type=str, action="store")
+    parser.add_argument('--topo', help='Topology file',
+                        type=str, action="store", required=False,
+                        default='topology.json')
+    parser.add_argument('-s', '--switches', help='Only save or restore these switches',
+                        type=str, action="store", required=False, nargs='+',
+                        default=[], metavar='SWITCH')
+    parser.add_argument('-j', '--jobs', help='Number of switches handled concurrently',
+                        type=int, action="store", required=False,
+                        default=PROVISION_JOBS)
+    parser.add_argument('--rebase', help='On restore, shift the timestamps of each '
+                        'switch so that the most recent one is the current data '
+                        'plane time of the switch (its latest port_util_last_updated), '
+                        'for switches that restarted since the checkpoint',
+                        action="store_true", required=False, default=False)
+    parser.add_argument('--time-base', help='On restore, shift the timestamps of each '
+                        'switch so that the most recent one is TIME_BASE microseconds',
+                        type=int, action="store", required=False, default=None)
+    args = parser.parse_args()
+
+    if not os.path.exists(args.topo):
+        parser.print_help()
+        print "\nTopology file not found: %s" % args.topo
+        parser.exit(1)
+    if args.command == 'restore' and not os.path.exists(args.checkpoint):
+        parser.print_help()
+        print "\nCheckpoint file not found: %s" % args.checkpoint
+        parser.exit(1)
+    main(args.topo, args.command, args.checkpoint, args.switches, args.jobs,
+         args.time_base, args.rebase)
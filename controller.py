@@ -1,57 +1,219 @@
 #!/usr/bin/env python2
-import argparse, re, grpc, os, sys, json, subprocess
+import argparse, re, grpc, os, sys, json, subprocess, hashlib, cPickle
+import socket, struct, time, random, heapq, threading
+from Queue import Queue, Empty
 import networkx as nx
 
 sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'utils/'))
 import p4runtime_lib.helper
+from p4 import p4runtime_pb2
+from p4.tmp import p4config_pb2
+from google.rpc import code_pb2
+from google.protobuf.message import DecodeError
 
-from p4runtime_lib.switch import ShutdownAllSwitchConnections
+from p4runtime_lib.switch import ShutdownAllSwitchConnections, WRITE_BATCH_SIZE
+from p4runtime_lib.switch import buildTableUpdates, buildWriteRequests
 from p4runtime_lib.convert import decodeMac, decodeIPv4
-from switch_utils import printGrpcError,load_topology,run_ssc_cmd
+from switch_utils import printGrpcError,printWriteErrors,load_topology
+from switch_utils import run_concurrently,printSwitchReport,PROVISION_JOBS
+from switch_utils import tor_switches,tor_indices,CPU_PORT
+from thrift_runtime import GetThriftClient, DropThriftClient, ShutdownAllThriftClients
 
 # Turn on dry run mode
 debug = False
 
+# Bump whenever the layout of provisioning plans changes.
+PLAN_VERSION = 7
+
+# Default time between two probes sent by the controller from a ToR, in
+# milliseconds, and the relative jitter applied to it.
+PROBE_INTERVAL = 100
+PROBE_JITTER = 0.1
+
+# Time between two probes sent from the hosts by test-scripts/probe.py, in
+# milliseconds.
+HOST_PROBE_INTERVAL = 1000
+
+# Switches replicate the probes of a ToR that did not change its path once per
+# keep-alive time, this many probe periods. With less than a period, every
+# probe is due as a keep-alive and none are suppressed.
+PROBE_KEEP_ALIVE_PERIODS = 3
+
+# Probe keep-alive time in microseconds for probes sent every `probe_interval`
+# milliseconds.
+def probe_keep_alive_time(probe_interval):
+    return int(PROBE_KEEP_ALIVE_PERIODS * probe_interval * 1000)
+
+# Path utilization and update time of the HULA state seeded at provisioning,
+# so that the first probe for a ToR always replaces the seeded best hop.
+SEED_PATH_UTIL = 255
+SEED_UPDATE_TIME = 0
+
+# In daemon mode, seconds between two checks that every switch still has its
+# pipeline and tables, and the attempts made at reprovisioning a switch that
+# lost them, one second apart. The check reads HEALTH_CHECK_TABLE, which
+# provisioning always fills.
+HEALTH_CHECK_INTERVAL = 10
+HEALTH_CHECK_TABLE = "MyIngress.hula_logic"
+REPROVISION_ATTEMPTS = 30
+
+# Id of the switches that are not ToRs. Matches NOT_A_TOR in switch.p4.
+NOT_A_TOR = 0xffffff
+
+# Probes are replicated either through one multicast group per ingress port
+# ('per-port'), or through a single group to every port whose copies are
+# pruned in egress by port role ('broadcast').
+MCAST_MODES = ['per-port', 'broadcast']
+# Id of the broadcast group, above the per-port group ids.
+BROADCAST_GROUP = 512
+# Port roles, matching switch.p4.
+ROLE_UPSTREAM = 1
+
 # Generate a simple UID for dst_id of each host
 def host_to_dst_id(hosts):
     return dict(zip(hosts, range(1, len(hosts) + 1)))
 
-def mcast_grp_command(mcast_id, port_ids, handle_id):
-    port_seq = " ".join(str(e) for e in port_ids)
-    create = "mc_mgrp_create " + str(mcast_id)
-    node = "mc_node_create 0 " + port_seq
-    assoc = "mc_node_associate " + str(mcast_id) + " " + str(handle_id)
-    return create + "\n" + node + "\n" + assoc
-
-def install_smart_mcast(mn_topo, switches, p4info_helper):
-    # Note(rachit): Hosts are always considered downstream.
-    def is_upstream(x, y):
-        return x[0] == y[0] and int(x[1]) < int(y[1])
-
+def topo_graph(mn_topo):
     G = nx.Graph()
     G.add_edges_from(mn_topo.links())
-    # Generate mcast commands and store them in config/<switch>
+    return G
+
+# Whether `y` is upstream of the switch `x`, i.e. in a higher tier.
+# Note(rachit): Hosts are always considered downstream.
+def is_upstream(mn_topo, x, y):
+    return mn_topo.tier(x) < mn_topo.tier(y)
+
+# Compute the multicast groups of each switch as a list of (group id, ports).
+# The group id of the packets coming in on a port is the port number.
+def smart_mcast_groups(mn_topo):
+    G = topo_graph(mn_topo)
+    groups = {}
     for switch in mn_topo.switches():
-        command = ""
+        groups[switch] = []
         adjacents = map(lambda (_, a): a, G.edges(switch))
         for adj in adjacents:
             mcast_adjs = None
             # If the packet came from an upstream link, cast it to only downstream links
-            if is_upstream(switch, adj):
-                mcast_adjs = filter(lambda a: not is_upstream(switch, a), adjacents)
+            if is_upstream(mn_topo, switch, adj):
+                mcast_adjs = filter(lambda a: not is_upstream(mn_topo, switch, a), adjacents)
             # If the packet came from a downstream link, cast it at all other links.
             else:
                 mcast_adjs = filter(lambda a: a != adj, adjacents)
 
             mcast_ports = map(lambda a: mn_topo.port(switch, a)[0], mcast_adjs)
             ingress_port = mn_topo.port(switch, adj)[0]
-            cmd = mcast_grp_command(ingress_port, mcast_ports,
-                                    switches[switch].getAndUpdateHandleId())
-            command += (cmd + "\n")
-        # Execute mcast setup
-        print run_ssc_cmd(switch, command)
+            groups[switch].append((ingress_port, mcast_ports))
+    # Probes sent by the controller at a ToR go out on every port.
+    for tor in tor_switches(mn_topo):
+        all_ports = map(lambda a: mn_topo.port(tor, a)[0], G.neighbors(tor))
+        groups[tor].append((CPU_PORT, all_ports))
+    return groups
+
+# Switches that rejected PRE writes over P4Runtime. Their multicast groups are
+# created through the thrift runtime server instead.
+pre_unsupported = set()
+
+# Install the multicast groups of a switch in one batched P4Runtime write. The
+# groups the target does not let us write over P4Runtime fall back to thrift.
+def install_mcast_groups(bmv2_switch, groups, p4info_helper):
+    switch = bmv2_switch.name
+    if debug:
+        print "%s: multicast groups %s" % (switch, groups)
+        return
+
+    fallback_ids = set(mcast_id for mcast_id, _ in groups)
+    if switch not in pre_unsupported:
+        mcast_entries = [p4info_helper.buildMulticastGroupEntry(mcast_id, ports)
+                         for mcast_id, ports in groups]
+        try:
+            failures = bmv2_switch.WriteMCastEntries(mcast_entries)
+        except grpc.RpcError as e:
+            if e.code() != grpc.StatusCode.UNIMPLEMENTED:
+                raise
+        else:
+            unimplemented = [u for (u, e) in failures
+                             if e.canonical_code == code_pb2.UNIMPLEMENTED]
+            printWriteErrors(switch, [(u, e) for (u, e) in failures
+                                      if e.canonical_code != code_pb2.UNIMPLEMENTED])
+            fallback_ids = set(u.entity.packet_replication_engine_entry
+                                .multicast_group_entry.multicast_group_id
+                               for u in unimplemented)
+        if not fallback_ids:
+            return
+        pre_unsupported.add(switch)
+
+    client = GetThriftClient(switch)
+    for mcast_id, ports in groups:
+        if mcast_id in fallback_ids:
+            client.mc_group_create(mcast_id, ports)
+
+# A single group per switch replicating to all its ports. Copies are pruned
+# in egress, see port_role_entries.
+def broadcast_mcast_groups(mn_topo):
+    G = topo_graph(mn_topo)
+    return dict((sw, [(BROADCAST_GROUP,
+                       sorted(mn_topo.port(sw, a)[0] for a in G.neighbors(sw)))])
+                for sw in mn_topo.switches())
 
-def install_hula_logic(mn_topo, switches, p4info_helper):
+def mcast_groups(mn_topo, mcast_mode):
+    if mcast_mode == 'broadcast':
+        return broadcast_mcast_groups(mn_topo)
+    return smart_mcast_groups(mn_topo)
+
+# Entries marking the upstream ports of each switch in the port role tables
+# used to prune the copies of the broadcast group. Other ports are downstream.
+def port_role_entries(mn_topo, p4info_helper):
+    G = topo_graph(mn_topo)
+    entries = dict((sw, []) for sw in mn_topo.switches())
+    for sw in mn_topo.switches():
+        for adj in G.neighbors(sw):
+            if not is_upstream(mn_topo, sw, adj):
+                continue
+            port = mn_topo.port(sw, adj)[0]
+            for direction in ["ingress", "egress"]:
+                entries[sw].append(p4info_helper.buildTableEntry(
+                    table_name="MyEgress.%s_port_role" % direction,
+                    match_fields = {
+                        "standard_metadata.%s_port" % direction: port
+                    },
+                    action_name="MyEgress.set_%s_role" % direction,
+                    action_params={
+                        "role": ROLE_UPSTREAM
+                    }))
+    return entries
+
+# Compute the initial HULA state of each switch as a list of (register, index,
+# value). The best hop towards every other ToR is the next hop of a shortest
+# path, so data packets are forwarded before any probe came in. Ties between
+# equal cost next hops are broken by ToR id to spread the load.
+def seed_registers(mn_topo):
+    G = topo_graph(mn_topo)
+    G.remove_nodes_from(mn_topo.hosts())
+    seeds = dict((sw, []) for sw in mn_topo.switches())
+    for tor, dst_tor in tor_indices(mn_topo).iteritems():
+        dist = nx.single_source_shortest_path_length(G, tor)
+        for sw in mn_topo.switches():
+            if sw == tor or sw not in dist:
+                continue
+            next_hops = sorted(n for n in G.neighbors(sw) if dist.get(n) == dist[sw] - 1)
+            next_hop = next_hops[dst_tor % len(next_hops)]
+            seeds[sw].extend([
+                ("MyIngress.best_hop", dst_tor, mn_topo.port(sw, next_hop)[0]),
+                ("MyIngress.min_path_util", dst_tor, SEED_PATH_UTIL),
+                ("MyIngress.update_time", dst_tor, SEED_UPDATE_TIME),
+            ])
+    return seeds
+
+def install_seed_registers(bmv2_switch, seeds):
+    if debug:
+        print "%s: seeding %d registers" % (bmv2_switch.name, len(seeds))
+        return
+    client = GetThriftClient(bmv2_switch.name)
+    for register_name, index, value in seeds:
+        client.register_write(register_name, index, value)
+
+def hula_logic_entries(mn_topo, p4info_helper):
+    entries = {}
     for sw in mn_topo.switches():
         add_hula_handle_probe = p4info_helper.buildTableEntry(
             table_name="MyIngress.hula_logic",
@@ -69,13 +231,21 @@ def install_hula_logic(mn_topo, switches, p4info_helper):
             action_name = "MyIngress.hula_handle_data_packet",
             action_params = {
         })
-        switches[sw].WriteTableEntry(add_hula_handle_probe, debug)
-        switches[sw].WriteTableEntry(add_hula_handle_data_packet, debug)
+        entries[sw] = [add_hula_handle_probe, add_hula_handle_data_packet]
+    return entries
+
+# Returns the network address of `ip` for a prefix of `prefix_len` bits.
+def ip_network(ip, prefix_len):
+    mask = (0xffffffff << (32 - prefix_len)) & 0xffffffff
+    network = struct.unpack("!I", socket.inet_aton(ip))[0] & mask
+    return socket.inet_ntoa(struct.pack("!I", network))
 
-def install_tables(mn_topo, switches, p4info_helper):
-    # Install entries for hula_logic
-    install_hula_logic(mn_topo, switches, p4info_helper)
-    # Install rule to map each host to dst_tor
+def forwarding_entries(mn_topo, p4info_helper, probe_keep_alive,
+                       bcast_grp=0):
+    entries = dict((sw, []) for sw in mn_topo.switches())
+    tor_index = tor_indices(mn_topo)
+    # Subnets of the hosts connected to each ToR as (network, prefix length)
+    tor_subnets = {}
     for (x, y) in mn_topo.links():
         switch = None
         host= None
@@ -87,8 +257,7 @@ def install_tables(mn_topo, switches, p4info_helper):
             host = y
         else:
             continue
-        host_ip = mn_topo.nodeInfo(host)['ip'].split('/')[0]
-        dst_tor_num = int(switch[1:])
+        host_ip, prefix_len = mn_topo.nodeInfo(host)['ip'].split('/')
         port = mn_topo.port(switch, host)[0]
 
         # Install entries for edge forwarding.
@@ -101,46 +270,427 @@ def install_tables(mn_topo, switches, p4info_helper):
             action_params={
                 "port": port,
             })
-        switches[switch].WriteTableEntry(add_edge_forward, debug)
+        entries[switch].append(add_edge_forward)
 
-        for sw in mn_topo.switches():
-            self_id = int(sw[1:])
-            # Install entries to calculate get_dst_tor
-            add_host_dst_tor = p4info_helper.buildTableEntry(
-                table_name="MyIngress.get_dst_tor",
-                match_fields = {
-                    "hdr.ipv4.dstAddr": host_ip
-                },
-                action_name="MyIngress.set_dst_tor",
-                action_params={
-                    "dst_tor": dst_tor_num,
-                    "self_id": self_id
-                })
-            switches[sw].WriteTableEntry(add_host_dst_tor, debug)
-
-
-
-def main(p4info_file_path, bmv2_file_path, topo_file_path):
+        # Probes from the host get the id of the ToR.
+        add_local_probe = p4info_helper.buildTableEntry(
+            table_name="MyIngress.local_probe",
+            match_fields = {
+                "standard_metadata.ingress_port": port
+            },
+            action_name="MyIngress.own_probe")
+        entries[switch].append(add_local_probe)
+
+        subnet = (ip_network(host_ip, int(prefix_len)), int(prefix_len))
+        tor_subnets.setdefault(switch, set()).add(subnet)
+
+    for sw in mn_topo.switches():
+        # Set the id of the switch through the default action of switch_config
+        set_switch_config = p4info_helper.buildTableEntry(
+            table_name="MyIngress.switch_config",
+            default_action=True,
+            action_name="MyIngress.set_switch_config",
+            action_params={
+                "self_id": tor_index.get(sw, NOT_A_TOR),
+                "probe_keep_alive": probe_keep_alive,
+                "bcast_grp": bcast_grp
+            })
+        entries[sw].append(set_switch_config)
+
+        # Install one entry per ToR subnet to calculate get_dst_tor
+        for tor, subnets in tor_subnets.iteritems():
+            for subnet in subnets:
+                add_tor_subnet = p4info_helper.buildTableEntry(
+                    table_name="MyIngress.get_dst_tor",
+                    match_fields = {
+                        "hdr.ipv4.dstAddr": subnet
+                    },
+                    action_name="MyIngress.set_dst_tor",
+                    action_params={
+                        "dst_tor": tor_index[tor]
+                    })
+                entries[sw].append(add_tor_subnet)
+    return entries
+
+def table_entries(mn_topo, p4info_helper, probe_keep_alive,
+                  mcast_mode='per-port'):
+    entries = hula_logic_entries(mn_topo, p4info_helper)
+    if mcast_mode == 'broadcast':
+        forwarding = forwarding_entries(mn_topo, p4info_helper, probe_keep_alive,
+                                        BROADCAST_GROUP)
+        for sw, sw_entries in port_role_entries(mn_topo, p4info_helper).iteritems():
+            entries[sw].extend(sw_entries)
+    else:
+        forwarding = forwarding_entries(mn_topo, p4info_helper, probe_keep_alive)
+    for sw, sw_entries in forwarding.iteritems():
+        entries[sw].extend(sw_entries)
+    return entries
+
+
+# Key identifying a table entry: two entries with the same key cannot coexist.
+def entry_key(entry):
+    return (entry.table_id, entry.priority,
+            tuple(sorted(m.SerializeToString() for m in entry.match)))
+
+def entry_action(entry):
+    action = entry.action.action
+    params = sorted((p.param_id, p.value) for p in action.params)
+    return (action.action_id, tuple(params))
+
+# Returns the updates turning the `current` entries of a switch into `desired`.
+def diff_table_entries(current, desired):
+    def update(update_type, entry):
+        u = p4runtime_pb2.Update()
+        u.type = update_type
+        u.entity.table_entry.CopyFrom(entry)
+        return u
+
+    current_by_key = dict((entry_key(e), e) for e in current)
+    desired_keys = set()
+    inserts, modifies, deletes = [], [], []
+    for entry in desired:
+        # Default actions are never returned by reads and can only be modified.
+        if entry.is_default_action:
+            modifies.append(update(p4runtime_pb2.Update.MODIFY, entry))
+            continue
+        key = entry_key(entry)
+        desired_keys.add(key)
+        if key not in current_by_key:
+            inserts.append(update(p4runtime_pb2.Update.INSERT, entry))
+        elif entry_action(current_by_key[key]) != entry_action(entry):
+            modifies.append(update(p4runtime_pb2.Update.MODIFY, entry))
+    for key, entry in current_by_key.iteritems():
+        if key not in desired_keys:
+            deletes.append(update(p4runtime_pb2.Update.DELETE, entry))
+    # Deletes go first so that a changed key never collides with a stale entry.
+    return deletes + inserts + modifies
+
+def read_table_entries(bmv2_switch):
+    entries = []
+    for response in bmv2_switch.ReadTableEntries():
+        for entity in response.entities:
+            entries.append(entity.table_entry)
+    return entries
+
+# Checks whether the switch already runs the pipeline described by `p4info`
+# and the BMv2 JSON file. A program change can leave the p4info untouched, so
+# the device config is compared too. A switch that does not return its device
+# config is considered out of date.
+def pipeline_installed(bmv2_switch, p4info, bmv2_file_path):
+    try:
+        response = bmv2_switch.GetForwardingPipelineConfig()
+    except grpc.RpcError:
+        return False
+    if response.config.p4info != p4info:
+        return False
+    device_config = p4config_pb2.P4DeviceConfig()
+    try:
+        device_config.ParseFromString(response.config.p4_device_config)
+    except DecodeError:
+        return False
+    expected = bmv2_switch.buildDeviceConfig(bmv2_json_file_path=bmv2_file_path)
+    return device_config.device_data == expected.device_data
+
+# A provisioning plan holds everything sent to a switch after its pipeline:
+# its multicast groups as (group id, ports), its table entries as serialized
+# WriteRequests and its seeded registers as (register, index, value).
+def compile_plan(mn_topo, p4info_helper, options):
+    groups = mcast_groups(mn_topo, options['mcast_mode'])
+    seeds = seed_registers(mn_topo)
+    entries = table_entries(mn_topo, p4info_helper, options['probe_keep_alive'],
+                            options['mcast_mode'])
+    plan = {}
+    for sw in mn_topo.switches():
+        requests = buildWriteRequests(buildTableUpdates(entries[sw]),
+                                      options['batch_size'])
+        plan[sw] = {
+            'mcast': groups[sw],
+            'writes': [r.SerializeToString() for r in requests],
+            'registers': seeds[sw]
+        }
+    return plan
+
+def plan_table_entries(switch_plan):
+    entries = []
+    for raw in switch_plan['writes']:
+        request = p4runtime_pb2.WriteRequest.FromString(raw)
+        entries.extend(u.entity.table_entry for u in request.updates)
+    return entries
+
+# Plans only depend on these files and the controller options, so they are
+# cached under a hash of all of them.
+def plan_fingerprint(file_paths, options):
+    h = hashlib.sha1("%d %r" % (PLAN_VERSION, sorted(options.items())))
+    for path in file_paths:
+        with open(path, 'rb') as f:
+            h.update(f.read())
+    return h.hexdigest()
+
+def load_plan(cache_dir, fingerprint, mn_topo, p4info_helper, options):
+    if cache_dir is None:
+        return compile_plan(mn_topo, p4info_helper, options)
+    cache_file = os.path.join(cache_dir, "%s.plan" % fingerprint)
+    if os.path.exists(cache_file):
+        print "Using cached provisioning plan %s" % cache_file
+        with open(cache_file, 'rb') as f:
+            return cPickle.load(f)
+    plan = compile_plan(mn_topo, p4info_helper, options)
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    # Write to a temporary file first so that an interrupted run never leaves
+    # a truncated plan behind.
+    tmp_file = "%s.%d.tmp" % (cache_file, os.getpid())
+    with open(tmp_file, 'wb') as f:
+        cPickle.dump(plan, f, cPickle.HIGHEST_PROTOCOL)
+    os.rename(tmp_file, cache_file)
+    return plan
+
+# Bring up a single switch: pipeline, multicast groups, tables and seeded
+# registers. The connection arbitrates for mastership before the first write.
+# With `reconcile`, a switch already running the pipeline only receives the
+# table updates needed to match its plan and keeps its learned state.
+def provision_switch(bmv2_switch, p4info_helper, bmv2_file_path, switch_plan,
+                     batch_size, reconcile=False):
+    if reconcile and pipeline_installed(bmv2_switch, p4info_helper.p4info,
+                                        bmv2_file_path):
+        updates = diff_table_entries(read_table_entries(bmv2_switch),
+                                     plan_table_entries(switch_plan))
+        print "%s: pipeline unchanged, %d table updates" % (bmv2_switch.name,
+                                                             len(updates))
+        failures = bmv2_switch.WriteUpdates(updates, batch_size, debug)
+    else:
+        bmv2_switch.SetForwardingPipelineConfig(p4info=p4info_helper.p4info,
+                                                bmv2_json_file_path=bmv2_file_path)
+        install_mcast_groups(bmv2_switch, switch_plan['mcast'], p4info_helper)
+        failures = []
+        for raw in switch_plan['writes']:
+            request = p4runtime_pb2.WriteRequest.FromString(raw)
+            failures.extend(bmv2_switch.SendWriteRequest(request, debug))
+        install_seed_registers(bmv2_switch, switch_plan['registers'])
+    printWriteErrors(bmv2_switch.name, failures)
+
+# A restarted bmv2 comes back without a pipeline, or without table entries if
+# it was started with the pipeline on the command line. Either way reading
+# the few entries of the table `table_id` fails or returns none, which is much
+# cheaper than fetching the pipeline and its BMv2 JSON.
+def needs_provisioning(bmv2_switch, table_id):
+    try:
+        for response in bmv2_switch.ReadTableEntries(table_id):
+            if len(response.entities) > 0:
+                return False
+    except grpc.RpcError:
+        pass
+    return True
+
+# Program a single switch from scratch on a fresh session. The rest of the
+# fabric is left alone.
+def reprovision_switch(bmv2_switch, p4info_helper, bmv2_file_path, switch_plan,
+                       batch_size):
+    print "%s: reprovisioning" % bmv2_switch.name
+    bmv2_switch.disconnect()
+    DropThriftClient(bmv2_switch.name)
+    provision_switch(bmv2_switch, p4info_helper, bmv2_file_path, switch_plan,
+                     batch_size)
+
+# Switches whose stream channel broke, most likely because they restarted.
+lost_switches = Queue()
+
+# Handlers for the messages switches send on their stream channel.
+def on_arbitration(bmv2_switch, arbitration):
+    if arbitration.status.code != code_pb2.OK:
+        print "%s: not the master controller (%s)" % (bmv2_switch.name,
+                                                      arbitration.status.message)
+
+def on_packet_in(bmv2_switch, packet):
+    print "%s: packet-in of %d bytes" % (bmv2_switch.name, len(packet.payload))
+
+def on_digest(bmv2_switch, digest):
+    print "%s: digest %d with %d entries" % (bmv2_switch.name, digest.digest_id,
+                                             len(digest.data))
+
+def on_idle_timeout(bmv2_switch, notification):
+    print "%s: %d table entries timed out" % (bmv2_switch.name,
+                                              len(notification.table_entry))
+
+def on_stream_closed(bmv2_switch, error):
+    if error is not None:
+        print "%s: stream channel closed (%s)" % (bmv2_switch.name, error.code().name)
+        lost_switches.put(bmv2_switch.name)
+
+stream_handlers = {
+    'arbitration': on_arbitration,
+    'packet': on_packet_in,
+    'digest': on_digest,
+    'idle_timeout_notification': on_idle_timeout,
+    'closed': on_stream_closed,
+}
+
+# Build the packet of a probe originating from the ToR with id `dst_tor`.
+def build_probe(dst_tor):
+    ethernet = '\xff' * 6 + '\x00' * 6 + struct.pack("!H", 0x800)
+    # The checksum is left empty, switches recompute it.
+    ipv4 = struct.pack("!BBHHHBBH4s4s", 0x45, 0, 20 + 4, 0, 0, 64, 0x42, 0,
+                       socket.inet_aton("0.0.0.0"),
+                       socket.inet_aton("224.0.0.1"))
+    hula = struct.pack("!I", dst_tor << 8)
+    return ethernet + ipv4 + hula
+
+# Reads the probe interval of each ToR in milliseconds. A ToR can override
+# the default with a "probe_interval" property in the topology file.
+def probe_intervals(topo_file_path, tors, default_interval):
+    with open(topo_file_path) as topo_data:
+        json_switches = json.load(topo_data)['switches']
+    return dict((tor, json_switches.get(tor, {}).get('probe_interval', default_interval))
+                for tor in tors)
+
+# Send probes from every ToR through PacketOut, forever. Every ToR starts at
+# a random phase and each interval is jittered so that ToRs don't synchronize.
+def send_probes(switches, tor_index, intervals, jitter):
+    probes = dict((tor, build_probe(tor_index[tor])) for tor in intervals)
+    now = time.time()
+    schedule = [(now + random.uniform(0, intervals[tor] / 1000.0), tor)
+                for tor in intervals]
+    heapq.heapify(schedule)
+    while schedule:
+        send_time, tor = heapq.heappop(schedule)
+        delay = send_time - time.time()
+        if delay > 0:
+            time.sleep(delay)
+        try:
+            switches[tor].PacketOut(probes[tor])
+        except (grpc.RpcError, Empty):
+            # The switch is down or did not answer the mastership arbitration,
+            # it gets reprovisioned by the daemon.
+            pass
+        interval = intervals[tor] / 1000.0 * random.uniform(1 - jitter, 1 + jitter)
+        heapq.heappush(schedule, (send_time + interval, tor))
+
+def describe_error(e):
+    if isinstance(e, grpc.RpcError):
+        return e.code().name
+    return "%s: %s" % (type(e).__name__, e)
+
+# Reprovision a switch once it answers again, then resume reading its stream.
+# A restarting switch can fail over gRPC, over thrift or by not answering the
+# mastership arbitration in time, so any error is retried.
+def recover_switch(bmv2_switch, reprovision):
+    for attempt in range(REPROVISION_ATTEMPTS):
+        try:
+            reprovision(bmv2_switch.name)
+        except Exception as e:
+            print "%s: reprovisioning failed (%s), retrying" % (bmv2_switch.name,
+                                                               describe_error(e))
+            time.sleep(1)
+            continue
+        bmv2_switch.startStreamReader()
+        print "%s: recovered" % bmv2_switch.name
+        return
+    print "%s: still unreachable, giving up for now" % bmv2_switch.name
+
+# Keep the sessions to all switches open and dispatch the messages they send
+# until interrupted. If `intervals` is given, also send probes from the ToRs,
+# whose ids are given by `tor_index`.
+# Switches that restart are detected when their stream breaks or by a
+# periodic `needs_provisioning(switch)` check, and passed to `reprovision`.
+# Checks run `jobs` switches at a time, and recoveries in the background as
+# soon as a switch is found lost, so neither waits on the rest of the fabric.
+def run_daemon(switches, needs_provisioning, reprovision, intervals=None,
+               jitter=PROBE_JITTER, tor_index=None, jobs=PROVISION_JOBS):
+    for bmv2_switch in switches.values():
+        for kind, handler in stream_handlers.iteritems():
+            bmv2_switch.addStreamHandler(kind, handler)
+        bmv2_switch.startStreamReader()
+    if intervals:
+        prober = threading.Thread(target=send_probes, name="probes",
+                                  args=(switches, tor_index, intervals, jitter))
+        prober.daemon = True
+        prober.start()
+        print "Sending probes from %d ToRs" % len(intervals)
+    print "Controller running, press Ctrl-C to stop."
+
+    # Switches being recovered, left out of the checks until they are done.
+    recovering = set()
+    recovering_lock = threading.Lock()
+
+    def recover(lost):
+        try:
+            run_concurrently(lost, lambda sw: recover_switch(switches[sw], reprovision),
+                             jobs)
+        finally:
+            with recovering_lock:
+                recovering.difference_update(lost)
+
+    last_check = time.time()
+    while True:
+        lost = set()
+        try:
+            lost.add(lost_switches.get(timeout=1))
+            while True:
+                lost.add(lost_switches.get_nowait())
+        except Empty:
+            pass
+        if time.time() - last_check > HEALTH_CHECK_INTERVAL:
+            with recovering_lock:
+                healthy = [sw for sw in switches if sw not in recovering]
+            report = run_concurrently(healthy, needs_provisioning, jobs)
+            lost.update(sw for sw, (_, error, result) in report.iteritems()
+                        if error is None and result)
+            last_check = time.time()
+        with recovering_lock:
+            lost = sorted(lost - recovering)
+            recovering.update(lost)
+        if lost:
+            recoverer = threading.Thread(target=recover, args=(lost,),
+                                         name="recover-%s" % ",".join(lost))
+            recoverer.daemon = True
+            recoverer.start()
+
+def main(p4info_file_path, bmv2_file_path, topo_file_path, jobs, reconcile,
+         plan_cache_dir, options, daemon, probe_interval, probe_jitter, log_options,
+         record_dir, reprovision):
     # Instantiate a P4Runtime helper from the p4info file
     p4info_helper = p4runtime_lib.helper.P4InfoHelper(p4info_file_path)
 
     try:
         # Load the topology from the JSON file
-        switches, mn_topo = load_topology(topo_file_path)
+        if record_dir is not None and not os.path.isdir(record_dir):
+            os.makedirs(record_dir)
+        switches, mn_topo = load_topology(topo_file_path, record_dir, **log_options)
+        unknown = set(reprovision or []) - set(switches)
+        if unknown:
+            print "Unknown switches: %s" % ", ".join(sorted(unknown))
+            return
+
+        fingerprint = plan_fingerprint([topo_file_path, p4info_file_path,
+                                        bmv2_file_path], options)
+        plan = load_plan(plan_cache_dir, fingerprint, mn_topo, p4info_helper,
+                         options)
 
-        # Establish a P4 Runtime connection to each switch
-        for bmv2_switch in switches.values():
-            bmv2_switch.MasterArbitrationUpdate()
-            print "Established as controller for %s" % bmv2_switch.name
+        # Provision every switch independently of the others
+        def provision(sw):
+            provision_switch(switches[sw], p4info_helper, bmv2_file_path,
+                             plan[sw], options['batch_size'], reconcile)
 
-        # Load the P4 program onto each switch
-        for bmv2_switch in switches.values():
-            bmv2_switch.SetForwardingPipelineConfig(p4info=p4info_helper.p4info,
-                                                    bmv2_json_file_path=bmv2_file_path)
-            print "Installed P4 Program using SetForwardingPipelineConfig on %s" % bmv2_switch.name
+        def reprovision_one(sw):
+            reprovision_switch(switches[sw], p4info_helper, bmv2_file_path,
+                               plan[sw], options['batch_size'])
 
-        install_smart_mcast(mn_topo, switches, p4info_helper)
-        install_tables(mn_topo, switches, p4info_helper)
+        if reprovision:
+            report = run_concurrently(reprovision, reprovision_one, jobs)
+        else:
+            report = run_concurrently(mn_topo.switches(), provision, jobs)
+        printSwitchReport(report)
+
+        if daemon:
+            intervals = None
+            if probe_interval is not None:
+                intervals = probe_intervals(topo_file_path, tor_switches(mn_topo),
+                                            probe_interval)
+            health_table = p4info_helper.get_tables_id(HEALTH_CHECK_TABLE)
+            run_daemon(switches,
+                       lambda sw: needs_provisioning(switches[sw], health_table),
+                       reprovision_one, intervals, probe_jitter, tor_indices(mn_topo),
+                       jobs)
 
     except KeyboardInterrupt:
         print " Shutting down."
@@ -148,6 +698,7 @@ def main(p4info_file_path, bmv2_file_path, topo_file_path):
         printGrpcError(e)
 
     ShutdownAllSwitchConnections()
+    ShutdownAllThriftClients()
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='P4Runtime Controller')
@@ -160,6 +711,53 @@ if __name__ == '__main__':
     parser.add_argument('--topo', help='Topology file',
                         type=str, action="store", required=False,
                         default='topology.json')
+    parser.add_argument('--batch-size', help='Maximum number of updates per WriteRequest',
+                        type=int, action="store", required=False,
+                        default=WRITE_BATCH_SIZE)
+    parser.add_argument('-j', '--jobs', help='Number of switches provisioned concurrently',
+                        type=int, action="store", required=False,
+                        default=PROVISION_JOBS)
+    parser.add_argument('--reconcile', help='Only send the table updates needed '
+                        'to bring switches running the same pipeline up to date',
+                        action="store_true", required=False, default=False)
+    parser.add_argument('--plan-cache', help='Directory caching compiled provisioning plans',
+                        type=str, action="store", required=False,
+                        default='./build/plans')
+    parser.add_argument('--no-plan-cache', help='Always rebuild the provisioning plan',
+                        action="store_true", required=False, default=False)
+    parser.add_argument('--probe-keep-alive', help='Time in microseconds between two '
+                        'replicated probes of a ToR that did not change its best path. '
+                        'Defaults to %d probe periods, of --probes if given and of '
+                        'the host probes otherwise' % PROBE_KEEP_ALIVE_PERIODS,
+                        type=int, action="store", required=False, default=None)
+    parser.add_argument('-d', '--daemon', help='Keep running after provisioning and '
+                        'handle the messages sent by the switches',
+                        action="store_true", required=False, default=False)
+    parser.add_argument('--probes', help='In daemon mode, send HULA probes from every '
+                        'ToR every PROBE_INTERVAL milliseconds',
+                        type=float, action="store", required=False, nargs='?',
+                        const=PROBE_INTERVAL, default=None, metavar='PROBE_INTERVAL')
+    parser.add_argument('--probe-jitter', help='Relative jitter applied to probe intervals',
+                        type=float, action="store", required=False,
+                        default=PROBE_JITTER)
+    parser.add_argument('--log-sample', help='Only log every N-th P4Runtime request',
+                        type=int, action="store", required=False, default=1,
+                        metavar='N')
+    parser.add_argument('--log-errors-only', help='Only log the P4Runtime requests that failed',
+                        action="store_true", required=False, default=False)
+    parser.add_argument('--record', help='Record the requests that program each switch '
+                        'to RECORD_DIR/<switch>.bin, to be replayed with replay.py',
+                        type=str, action="store", required=False, default=None,
+                        metavar='RECORD_DIR')
+    parser.add_argument('--reprovision', help='Only reprogram the given switches from '
+                        'scratch, e.g. after they restarted',
+                        type=str, action="store", required=False, nargs='+',
+                        default=None, metavar='SWITCH')
+    parser.add_argument('--mcast-mode', help='Replicate probes through one multicast '
+                        'group per ingress port, or through a single group per switch '
+                        'pruned in egress by port role',
+                        type=str, action="store", required=False,
+                        choices=MCAST_MODES, default='per-port')
     args = parser.parse_args()
 
     if not os.path.exists(args.p4info):
@@ -174,4 +772,26 @@ if __name__ == '__main__':
         parser.print_help()
         print "\nTopology file not found: %s" % args.topo
         parser.exit(1)
-    main(args.p4info, args.bmv2_json, args.topo)
+    if args.record is not None and (args.reconcile or args.reprovision):
+        parser.print_help()
+        print "\n--record needs a full provisioning run, it cannot be used with " \
+              "--reconcile or --reprovision"
+        parser.exit(1)
+    if args.log_sample < 1:
+        parser.print_help()
+        print "\n--log-sample must be at least 1, got %d" % args.log_sample
+        parser.exit(1)
+    probe_keep_alive = args.probe_keep_alive
+    if probe_keep_alive is None:
+        probe_keep_alive = probe_keep_alive_time(
+            args.probes if args.probes is not None else HOST_PROBE_INTERVAL)
+    options = {
+        'batch_size': args.batch_size,
+        'probe_keep_alive': probe_keep_alive,
+        'mcast_mode': args.mcast_mode
+    }
+    main(args.p4info, args.bmv2_json, args.topo, args.jobs, args.reconcile,
+         None if args.no_plan_cache else args.plan_cache, options, args.daemon,
+         args.probes, args.probe_jitter,
+         {'log_sample_every': args.log_sample, 'log_errors_only': args.log_errors_only},
+         args.record, args.reprovision)
@@ -0,0 +1,143 @@
+#!/usr/bin/env python2
+#
+# Replays the P4Runtime requests recorded by `./controller.py --record DIR` to
+# bring a restarted fabric back to the recorded state without recomputing it.
+# Every switch gets the last pipeline it was sent and the table writes that
+# followed, merged into as few WriteRequests as possible.
+#
+import argparse, grpc, os, sys, time
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'utils/'))
+import p4runtime_lib.helper
+from p4 import p4runtime_pb2
+
+from p4runtime_lib.switch import ShutdownAllSwitchConnections, buildWriteRequests
+from p4runtime_lib.request_log import readRecords, parseRequest, FLAG_ERROR
+from switch_utils import printGrpcError,printWriteErrors,load_topology,record_file
+from switch_utils import run_concurrently,printSwitchReport,PROVISION_JOBS
+from thrift_runtime import ShutdownAllThriftClients
+from controller import mcast_groups, install_mcast_groups, MCAST_MODES
+from controller import seed_registers, install_seed_registers
+
+# Maximum number of updates per WriteRequest during a replay
+REPLAY_BATCH_SIZE = 4096
+
+def is_pre_update(update):
+    return update.entity.WhichOneof('entity') == 'packet_replication_engine_entry'
+
+# Reduce a recording to the requests worth replaying: the last pipeline sent
+# to the switch and the updates of the writes that came after it. Multicast
+# updates the switch rejected were installed through thrift instead and are
+# dropped. Returns (pipeline request or None, updates, has_pre_writes).
+def load_recording(path):
+    pipeline = None
+    updates = []
+    has_pre_writes = False
+    for ts, flags, method_name, body in readRecords(path):
+        request = parseRequest(method_name, body)
+        if isinstance(request, p4runtime_pb2.SetForwardingPipelineConfigRequest):
+            if flags & FLAG_ERROR:
+                continue
+            # A new pipeline wipes the state written before it.
+            pipeline = request
+            updates = []
+            has_pre_writes = False
+            continue
+        for update in request.updates:
+            if is_pre_update(update):
+                if flags & FLAG_ERROR:
+                    continue
+                has_pre_writes = True
+            updates.append(update)
+    return (pipeline, updates, has_pre_writes)
+
+def replay_switch(bmv2_switch, recording, mcast_groups, seeds, p4info_helper,
+                  batch_size):
+    pipeline, updates, has_pre_writes = recording
+    if pipeline is not None:
+        bmv2_switch.SendPipelineConfigRequest(pipeline)
+    # Groups written through thrift are not part of the recording.
+    if pipeline is not None and not has_pre_writes:
+        install_mcast_groups(bmv2_switch, mcast_groups, p4info_helper)
+    failures = []
+    for request in buildWriteRequests(updates, batch_size):
+        failures.extend(bmv2_switch.SendWriteRequest(request))
+    # So are the registers seeded after a new pipeline.
+    if pipeline is not None:
+        install_seed_registers(bmv2_switch, seeds)
+    printWriteErrors(bmv2_switch.name, failures)
+    return len(updates)
+
+def main(p4info_file_path, topo_file_path, record_dir, jobs, batch_size, mcast_mode):
+    p4info_helper = p4runtime_lib.helper.P4InfoHelper(p4info_file_path)
+
+    try:
+        switches, mn_topo = load_topology(topo_file_path)
+        groups = mcast_groups(mn_topo, mcast_mode)
+        seeds = seed_registers(mn_topo)
+
+        recordings = {}
+        for sw in mn_topo.switches():
+            path = record_file(record_dir, sw)
+            if not os.path.exists(path):
+                print "%s: no recording in %s, skipping" % (sw, path)
+                continue
+            recording = load_recording(path)
+            if recording[0] is None:
+                # Table writes alone would fail on a switch without a pipeline.
+                print "%s: %s has no pipeline, it was not recorded from a full " \
+                      "provisioning run, skipping" % (sw, path)
+                continue
+            recordings[sw] = recording
+
+        def replay(sw):
+            return replay_switch(switches[sw], recordings[sw], groups[sw],
+                                 seeds[sw], p4info_helper, batch_size)
+
+        start = time.time()
+        report = run_concurrently(sorted(recordings), replay, jobs)
+        printSwitchReport(report)
+        print "Replayed %d updates to %d switches in %.3fs" % (
+            sum(r for (_, e, r) in report.values() if e is None),
+            len(recordings), time.time() - start)
+
+    except KeyboardInterrupt:
+        print " Shutting down."
+    except grpc.RpcError as e:
+        printGrpcError(e)
+
+    ShutdownAllSwitchConnections()
+    ShutdownAllThriftClients()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Replay recorded P4Runtime requests')
+    parser.add_argument('record_dir', help='Directory passed to controller.py --record',
+                        type=str, action="store")
+    parser.add_argument('--p4info', help='p4info proto in text format from p4c',
+                        type=str, action="store", required=False,
+                        default='./build/switch.p4info')
+    parser.add_argument('--topo', help='Topology file',
+                        type=str, action="store", required=False,
+                        default='topology.json')
+    parser.add_argument('--batch-size', help='Maximum number of updates per WriteRequest',
+                        type=int, action="store", required=False,
+                        default=REPLAY_BATCH_SIZE)
+    parser.add_argument('-j', '--jobs', help='Number of switches replayed concurrently',
+                        type=int, action="store", required=False,
+                        default=PROVISION_JOBS)
+    parser.add_argument('--mcast-mode', help='Multicast mode the recording was made with, '
+                        'used to rebuild groups created through thrift',
+                        type=str, action="store", required=False,
+                        choices=MCAST_MODES, default='per-port')
+    args = parser.parse_args()
+
+    if not os.path.isdir(args.record_dir):
+        parser.print_help()
+        print "\nRecording directory not found: %s" % args.record_dir
+        parser.exit(1)
+    if not os.path.exists(args.topo):
+        parser.print_help()
+        print "\nTopology file not found: %s" % args.topo
+        parser.exit(1)
+    main(args.p4info, args.topo, args.record_dir, args.jobs, args.batch_size,
+         args.mcast_mode)
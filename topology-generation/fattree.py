@@ -11,26 +11,36 @@ import argparse, json
 import networkx as nx
 from topolib import *
 
+# Tier and role of the switches of each level in the topology file
+TIERS = {'edge': 1, 'aggregation': 2, 'core': 3}
+ROLES = {'edge': 'tor', 'aggregation': 'aggregation', 'core': 'core'}
+
+# Addressing plan: every edge switch gets a /24 starting at 10.0.0.0.
+ADDRESSING = {'base': '10.0.0.0', 'prefix_len': 24}
+
 def mk_topo(pods, bw='1Gbps'):
     num_hosts         = (pods ** 3)/4
     num_agg_switches  = pods * pods
     num_core_switches = (pods * pods)/4
 
-    if num_agg_switches > 100:
-       raise Exception("Naming convention doesnt work with more than 100 aggregation switches.")
+    # Switches of tier n are named s<n * base + i>. The base leaves room for
+    # all the switches of a tier, so the first digit still gives the tier.
+    base = 100
+    while base < num_agg_switches:
+        base *= 10
 
     hosts = [('h' + str(i), {})
              for i in range (1, num_hosts + 1)]
 
     agg_switches = [('s' + str(i), {
         'type':'switch', 'level':'aggregation', 'id':i
-    }) for i in range(200, num_agg_switches + 200)]
+    }) for i in range(2 * base, num_agg_switches + 2 * base)]
 
     core_switches = [('s' + str(i), {
         'type':'switch', 'level':'core', 'id':i
-    }) for i in range(300, num_core_switches + 300)]
+    }) for i in range(3 * base, num_core_switches + 3 * base)]
 
-    edge_num = 100
+    edge_num = base
     for pod in range(pods):
         for sw in range(pods/2):
             agg_switches[(pod*pods) + sw][1]['level'] = 'edge'
@@ -109,6 +119,8 @@ if __name__ == '__main__':
         sws = filter(lambda n: n.startswith('s'), topo.nodes())
         switches = {}
         for switch in sws:
-            switches[switch] = {}
-        topology = {"hosts": hosts, "switches": switches, "links": links}
+            level = topo.get_node(switch).attr['level']
+            switches[switch] = {'tier': TIERS[level], 'role': ROLES[level]}
+        topology = {"hosts": hosts, "switches": switches, "links": links,
+                    "addressing": ADDRESSING}
         print json.dumps(topology, sort_keys=True, indent=4, separators=(',', ': '))
@@ -0,0 +1,26 @@
+#!/usr/bin/env python2
+#
+# Prints the number of ToRs of a topology file: the switches with the "tor"
+# role, or else the switches with hosts. Used by the Makefile to size the
+# per-ToR registers of switch.p4.
+#
+import json, sys
+
+def count_tors(topo_file_path):
+    with open(topo_file_path) as topo_data:
+        topo = json.load(topo_data)
+    host_switches = set()
+    for link in topo['links']:
+        x, y = link[0], link[1]
+        if x.startswith("h") and y.startswith("s"):
+            host_switches.add(y)
+        elif y.startswith("h") and x.startswith("s"):
+            host_switches.add(x)
+    tors = 0
+    for sw, info in topo['switches'].iteritems():
+        if info.get('role', 'tor' if sw in host_switches else None) == 'tor':
+            tors += 1
+    return tors
+
+if __name__ == '__main__':
+    print count_tors(sys.argv[1] if len(sys.argv) > 1 else 'topology.json')
@@ -20,6 +20,9 @@ from p4.config import p4info_pb2
 
 from convert import encode
 
+get_id_pattern = re.compile("^get_(\w+)_id$")
+get_name_pattern = re.compile("^get_(\w+)_name$")
+
 class P4InfoHelper(object):
     def __init__(self, p4_info_filepath):
         p4info = p4info_pb2.P4Info()
@@ -27,19 +30,50 @@ class P4InfoHelper(object):
         with open(p4_info_filepath) as p4info_f:
             google.protobuf.text_format.Merge(p4info_f.read(), p4info)
         self.p4info = p4info
+        self.buildIndices()
+
+    def buildIndices(self):
+        # entity type -> name/alias -> entity and entity type -> id -> entity,
+        # for every top-level entity list that has a preamble.
+        self.entities_by_name = {}
+        self.entities_by_id = {}
+        for field in self.p4info.DESCRIPTOR.fields:
+            if field.message_type is None or \
+               'preamble' not in field.message_type.fields_by_name:
+                continue
+            by_name = self.entities_by_name[field.name] = {}
+            by_id = self.entities_by_id[field.name] = {}
+            for o in getattr(self.p4info, field.name):
+                pre = o.preamble
+                # A name takes precedence over an alias of another entity.
+                by_name.setdefault(pre.alias, o)
+                by_name[pre.name] = o
+                by_id[pre.id] = o
+
+        # (table name, match field name or id) -> match field
+        self.match_fields = {}
+        for t in self.p4info.tables:
+            for mf in t.match_fields:
+                self.match_fields[(t.preamble.name, mf.name)] = mf
+                self.match_fields[(t.preamble.name, mf.id)] = mf
+
+        # (action name, param name or id) -> param, which carries the bitwidth
+        self.action_params = {}
+        for a in self.p4info.actions:
+            for p in a.params:
+                self.action_params[(a.preamble.name, p.name)] = p
+                self.action_params[(a.preamble.name, p.id)] = p
 
     def get(self, entity_type, name=None, id=None):
         if name is not None and id is not None:
             raise AssertionError("name or id must be None")
 
-        for o in getattr(self.p4info, entity_type):
-            pre = o.preamble
-            if name:
-                if (pre.name == name or pre.alias == name):
-                    return o
-            else:
-                if pre.id == id:
-                    return o
+        if name:
+            o = self.entities_by_name.get(entity_type, {}).get(name)
+        else:
+            o = self.entities_by_id.get(entity_type, {}).get(id)
+        if o is not None:
+            return o
 
         if name:
             raise AttributeError("Could not find %r of type %s" % (name, entity_type))
@@ -58,31 +92,30 @@ class P4InfoHelper(object):
     def __getattr__(self, attr):
         # Synthesize convenience functions for name to id lookups for top-level entities
         # e.g. get_tables_id(name_string) or get_actions_id(name_string)
-        m = re.search("^get_(\w+)_id$", attr)
+        # The synthesized function is stored on the instance so that later
+        # calls do not go through __getattr__ again.
+        m = get_id_pattern.search(attr)
         if m:
             primitive = m.group(1)
-            return lambda name: self.get_id(primitive, name)
+            f = lambda name: self.get_id(primitive, name)
+            setattr(self, attr, f)
+            return f
 
         # Synthesize convenience functions for id to name lookups
         # e.g. get_tables_name(id) or get_actions_name(id)
-        m = re.search("^get_(\w+)_name$", attr)
+        m = get_name_pattern.search(attr)
         if m:
             primitive = m.group(1)
-            return lambda id: self.get_name(primitive, id)
+            f = lambda id: self.get_name(primitive, id)
+            setattr(self, attr, f)
+            return f
 
         raise AttributeError("%r object has no attribute %r" % (self.__class__, attr))
 
     def get_match_field(self, table_name, name=None, id=None):
-        for t in self.p4info.tables:
-            pre = t.preamble
-            if pre.name == table_name:
-                for mf in t.match_fields:
-                    if name is not None:
-                        if mf.name == name:
-                            return mf
-                    elif id is not None:
-                        if mf.id == id:
-                            return mf
+        mf = self.match_fields.get((table_name, name if name is not None else id))
+        if mf is not None:
+            return mf
         raise AttributeError("%r has no attribute %r" % (table_name, name if name is not None else id))
 
     def get_match_field_id(self, table_name, match_field_name):
@@ -135,17 +168,10 @@ class P4InfoHelper(object):
             raise Exception("Unsupported match type with type %r" % match_type)
 
     def get_action_param(self, action_name, name=None, id=None):
-        for a in self.p4info.actions:
-            pre = a.preamble
-            if pre.name == action_name:
-                for p in a.params:
-                    if name is not None:
-                        if p.name == name:
-                            return p
-                    elif id is not None:
-                        if p.id == id:
-                            return p
-        raise AttributeError("action %r has no param %r, (has: %r)" % (action_name, name if name is not None else id, a.params))
+        p = self.action_params.get((action_name, name if name is not None else id))
+        if p is not None:
+            return p
+        raise AttributeError("action %r has no param %r" % (action_name, name if name is not None else id))
 
     def get_action_param_id(self, action_name, param_name):
         return self.get_action_param(action_name, name=param_name).id
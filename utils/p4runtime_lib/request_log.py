@@ -0,0 +1,119 @@
+#!/usr/bin/env python2
+#
+# Binary log of the P4Runtime requests sent to a switch.
+#
+# A log starts with LOG_MAGIC followed by one record per request: a
+# RECORD_HEADER (timestamp, flags, method name length, body length), the
+# method name and the serialized request. Serializing a protobuf is much
+# cheaper than rendering it as text, and the file is written by a background
+# thread, so logging costs almost nothing on the RPC path. Use
+#
+#   ./utils/p4runtime_lib/request_log.py logs/s1-p4runtime-requests.bin
+#
+# to render a log as text.
+#
+import argparse, struct, sys, threading, time
+from Queue import Queue
+from datetime import datetime
+
+LOG_MAGIC = 'P4RTLOG1'
+RECORD_HEADER = struct.Struct('!dBHI')
+
+# Set on records of requests that failed.
+FLAG_ERROR = 1
+
+# Size of the file buffer, flushed whenever the writer runs out of records.
+LOG_BUFFER_SIZE = 1 << 20
+
+MSG_LOG_MAX_LEN = 1024
+
+class RequestLogWriter(object):
+    """
+    Appends records to a log file from a background thread. `log` only
+    queues the record.
+    """
+
+    _sentinel = object()
+
+    def __init__(self, log_file):
+        self.log_file = log_file
+        self.records = Queue()
+        self.f = open(self.log_file, 'wb', LOG_BUFFER_SIZE)
+        self.f.write(LOG_MAGIC)
+        self.writer = threading.Thread(target=self.run, name="log-%s" % log_file)
+        self.writer.daemon = True
+        self.writer.start()
+
+    def log(self, method_name, body, flags=0, ts=None):
+        if ts is None:
+            ts = time.time()
+        self.records.put((ts, flags, method_name, body))
+
+    def run(self):
+        while True:
+            record = self.records.get()
+            if record is self._sentinel:
+                break
+            ts, flags, method_name, body = record
+            self.f.write(RECORD_HEADER.pack(ts, flags, len(method_name), len(body)))
+            self.f.write(method_name)
+            self.f.write(body)
+            if self.records.empty():
+                self.f.flush()
+        self.f.close()
+
+    def close(self):
+        if self.writer.is_alive():
+            self.records.put(self._sentinel)
+            self.writer.join()
+
+def readRecords(log_file):
+    """
+    Yields the (timestamp, flags, method name, serialized request) records of
+    a log file.
+    """
+    with open(log_file, 'rb') as f:
+        if f.read(len(LOG_MAGIC)) != LOG_MAGIC:
+            raise Exception("%s is not a P4Runtime request log" % log_file)
+        while True:
+            header = f.read(RECORD_HEADER.size)
+            if len(header) < RECORD_HEADER.size:
+                # End of file, or a record cut short by a crash.
+                return
+            ts, flags, method_len, body_len = RECORD_HEADER.unpack(header)
+            method_name = f.read(method_len)
+            body = f.read(body_len)
+            if len(body) < body_len:
+                return
+            yield (ts, flags, method_name, body)
+
+def parseRequest(method_name, body):
+    """
+    Parses the serialized request of a P4Runtime method, e.g.
+    '/p4.P4Runtime/Write' holds a WriteRequest.
+    """
+    from p4 import p4runtime_pb2
+
+    message = getattr(p4runtime_pb2, method_name.split('/')[-1] + 'Request')()
+    message.ParseFromString(body)
+    return message
+
+def renderLog(log_file, out=sys.stdout, max_len=MSG_LOG_MAX_LEN):
+    for ts, flags, method_name, body in readRecords(log_file):
+        ts = datetime.utcfromtimestamp(ts).strftime('%Y-%m-%d %H:%M:%S.%f')[:-3]
+        error = " (failed)" if flags & FLAG_ERROR else ""
+        out.write("\n[%s] %s%s\n---\n" % (ts, method_name, error))
+        msg = str(parseRequest(method_name, body))
+        if max_len is None or len(msg) < max_len:
+            out.write(msg)
+        else:
+            out.write("Message too long (%d bytes)! Skipping log...\n" % len(msg))
+        out.write('---\n')
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Render a binary P4Runtime request log as text')
+    parser.add_argument('log_file', help='Log written by GrpcRequestLogger')
+    parser.add_argument('--full', action='store_true', default=False,
+                        help='Print long messages instead of skipping them')
+    args = parser.parse_args()
+    renderLog(args.log_file, max_len=None if args.full else MSG_LOG_MAX_LEN)
@@ -14,13 +14,25 @@
 #
 from Queue import Queue
 from abc import abstractmethod
-from datetime import datetime
+import threading, time, traceback
 
 import grpc
+from google.rpc import code_pb2, status_pb2
 from p4 import p4runtime_pb2
 from p4.tmp import p4config_pb2
 
-MSG_LOG_MAX_LEN = 1024
+from request_log import RequestLogWriter, FLAG_ERROR
+
+# Maximum number of updates packed into a single WriteRequest
+WRITE_BATCH_SIZE = 512
+
+# Seconds to wait for the answer to an arbitration update once the stream is
+# consumed by a background reader
+ARBITRATION_TIMEOUT = 10
+
+# Requests captured in recordings, see replay.py
+RECORDED_METHODS = ('/p4.P4Runtime/SetForwardingPipelineConfig',
+                    '/p4.P4Runtime/Write')
 
 # List of all active connections
 connections = []
@@ -29,38 +41,146 @@ def ShutdownAllSwitchConnections():
     for c in connections:
         c.shutdown()
 
+def parseWriteErrors(e):
+    """
+    Returns the list of per-update p4runtime_pb2.Error carried in the trailing
+    metadata of a failed Write, or None if the error has no such details.
+    """
+    for key, value in e.trailing_metadata() or ():
+        if key != 'grpc-status-details-bin':
+            continue
+        status = status_pb2.Status()
+        status.ParseFromString(value)
+        errors = []
+        for detail in status.details:
+            error = p4runtime_pb2.Error()
+            if not detail.Unpack(error):
+                return None
+            errors.append(error)
+        return errors
+    return None
+
+def buildTableUpdates(table_entries, update_type=p4runtime_pb2.Update.INSERT):
+    updates = []
+    for table_entry in table_entries:
+        update = p4runtime_pb2.Update()
+        # Default actions always exist and can only be modified.
+        if table_entry.is_default_action:
+            update.type = p4runtime_pb2.Update.MODIFY
+        else:
+            update.type = update_type
+        update.entity.table_entry.CopyFrom(table_entry)
+        updates.append(update)
+    return updates
+
+def buildWriteRequests(updates, batch_size=WRITE_BATCH_SIZE):
+    """
+    Packs `updates` into WriteRequests of at most `batch_size` updates each.
+    The device and election ids are filled in when the request is sent.
+    """
+    requests = []
+    for start in range(0, len(updates), batch_size):
+        request = p4runtime_pb2.WriteRequest()
+        request.updates.extend(updates[start:start + batch_size])
+        requests.append(request)
+    return requests
+
 class SwitchConnection(object):
 
     def __init__(self, name=None, address='127.0.0.1:50051', device_id=0,
-                 proto_dump_file=None):
+                 proto_dump_file=None, log_sample_every=1, log_errors_only=False,
+                 record_file=None):
         self.name = name
         self.address = address
         self.device_id = device_id
         self.p4info = None
-        self.channel = grpc.insecure_channel(self.address)
-        if proto_dump_file is not None:
-            interceptor = GrpcRequestLogger(proto_dump_file)
-            self.channel = grpc.intercept_channel(self.channel, interceptor)
-        self.client_stub = p4runtime_pb2.P4RuntimeStub(self.channel)
-        self.requests_stream = IterableQueue()
-        self.stream_msg_resp = self.client_stub.StreamChannel(iter(self.requests_stream))
         self.proto_dump_file = proto_dump_file
-        self.current_handle_id = 0
-        connections.append(self)
+        self.log_sample_every = log_sample_every
+        self.log_errors_only = log_errors_only
+        self.request_logger = None
+        # Binary log of the requests that program the switch, for replay.py
+        self.record_file = record_file
+        self.recorder = None
+        # The channel and stream are opened, and mastership is requested, on
+        # first use. See connect() and ensureMaster().
+        self.channel = None
+        self.is_master = False
+        self.lock = threading.RLock()
+        # Stream message kind (e.g. 'packet' or 'digest') -> handlers
+        self.stream_handlers = {}
+        self.stream_reader = None
+        self.arbitration_responses = Queue()
+
+    def connect(self):
+        with self.lock:
+            if self.channel is not None:
+                return
+            channel = grpc.insecure_channel(self.address)
+            # The logs outlive reconnections.
+            if self.proto_dump_file is not None:
+                if self.request_logger is None:
+                    self.request_logger = GrpcRequestLogger(
+                        self.proto_dump_file, self.log_sample_every, self.log_errors_only)
+                channel = grpc.intercept_channel(channel, self.request_logger)
+            if self.record_file is not None:
+                if self.recorder is None:
+                    self.recorder = GrpcRequestLogger(self.record_file,
+                                                      methods=RECORDED_METHODS)
+                channel = grpc.intercept_channel(channel, self.recorder)
+            self._client_stub = p4runtime_pb2.P4RuntimeStub(channel)
+            self._requests_stream = IterableQueue()
+            self._stream_msg_resp = self._client_stub.StreamChannel(iter(self._requests_stream))
+            self.channel = channel
+            if self not in connections:
+                connections.append(self)
+
+    def disconnect(self):
+        """
+        Closes the channel and stream, e.g. after the switch restarted. The
+        next use opens new ones and arbitrates again. The stream reader, if
+        any, stops and has to be started again.
+        """
+        with self.lock:
+            if self.channel is None:
+                return
+            self._requests_stream.close()
+            self._stream_msg_resp.cancel()
+            self.channel = None
+            self.is_master = False
+            self.stream_reader = None
+            self.arbitration_responses = Queue()
+
+    @property
+    def client_stub(self):
+        self.connect()
+        return self._client_stub
 
-    # Return the current handle_id generated by mc_node_create. Assumes that
-    # handle_id being returned is immediately consumed.
-    def getAndUpdateHandleId(self):
-        self.current_handle_id += 1
-        return self.current_handle_id - 1
+    @property
+    def requests_stream(self):
+        self.connect()
+        return self._requests_stream
+
+    @property
+    def stream_msg_resp(self):
+        self.connect()
+        return self._stream_msg_resp
+
+    def ensureMaster(self):
+        with self.lock:
+            if not self.is_master:
+                self.MasterArbitrationUpdate()
 
     @abstractmethod
     def buildDeviceConfig(self, **kwargs):
         return p4config_pb2.P4DeviceConfig()
 
     def shutdown(self):
-        self.requests_stream.close()
-        self.stream_msg_resp.cancel()
+        with self.lock:
+            self.disconnect()
+            if self.request_logger is not None:
+                self.request_logger.close()
+            if self.recorder is not None:
+                self.recorder.close()
 
     def MasterArbitrationUpdate(self, dry_run=False, **kwargs):
         request = p4runtime_pb2.StreamMessageRequest()
@@ -70,10 +190,71 @@ class SwitchConnection(object):
 
         if dry_run:
             print "P4Runtime MasterArbitrationUpdate: ", request
+            return
+        if self.stream_reader is not None:
+            # The background reader owns the stream and hands us the answer.
+            self.requests_stream.put(request)
+            response = self.arbitration_responses.get(timeout=ARBITRATION_TIMEOUT)
         else:
             self.requests_stream.put(request)
+            response = None
             for item in self.stream_msg_resp:
-                return item # just one
+                response = item # just one
+                break
+        self.is_master = response is not None and \
+            response.arbitration.status.code == code_pb2.OK
+        return response
+
+    def PacketOut(self, payload, dry_run=False):
+        request = p4runtime_pb2.StreamMessageRequest()
+        request.packet.payload = payload
+        if dry_run:
+            print "P4Runtime PacketOut:", request
+        else:
+            self.ensureMaster()
+            self.requests_stream.put(request)
+
+    def addStreamHandler(self, kind, handler):
+        """
+        Registers `handler(connection, message)` for the stream messages of
+        `kind`, the name of the field set in the StreamMessageResponse (e.g.
+        'arbitration', 'packet', 'digest' or 'idle_timeout_notification').
+        The 'closed' handlers are called with the RpcError, or None, when the
+        stream terminates. Handlers run on the stream reader thread.
+        """
+        self.stream_handlers.setdefault(kind, []).append(handler)
+
+    def startStreamReader(self):
+        if self.stream_reader is not None:
+            return
+        self.stream_reader = threading.Thread(target=self.readStream,
+                                              args=(self.stream_msg_resp,),
+                                              name="%s-stream" % self.name)
+        self.stream_reader.daemon = True
+        self.stream_reader.start()
+
+    def dispatchStreamMessage(self, kind, message):
+        for handler in self.stream_handlers.get(kind, []):
+            try:
+                handler(self, message)
+            except Exception:
+                traceback.print_exc()
+
+    def readStream(self, stream):
+        error = None
+        try:
+            for item in stream:
+                kind = item.WhichOneof('update')
+                if kind is None:
+                    continue
+                if kind == 'arbitration':
+                    self.arbitration_responses.put(item)
+                self.dispatchStreamMessage(kind, getattr(item, kind))
+        except grpc.RpcError as e:
+            # Cancelled by shutdown() or disconnect()
+            if e.code() != grpc.StatusCode.CANCELLED:
+                error = e
+        self.dispatchStreamMessage('closed', error)
 
     def SetForwardingPipelineConfig(self, p4info, dry_run=False, **kwargs):
         device_config = self.buildDeviceConfig(**kwargs)
@@ -86,11 +267,28 @@ class SwitchConnection(object):
         config.p4_device_config = device_config.SerializeToString()
 
         request.action = p4runtime_pb2.SetForwardingPipelineConfigRequest.VERIFY_AND_COMMIT
+        self.SendPipelineConfigRequest(request, dry_run)
+
+    def SendPipelineConfigRequest(self, request, dry_run=False):
+        """
+        Sends a prepared SetForwardingPipelineConfigRequest to this switch.
+        """
+        request.device_id = self.device_id
+        request.election_id.low = 1
         if dry_run:
             print "P4Runtime SetForwardingPipelineConfig:", request
         else:
+            self.ensureMaster()
             self.client_stub.SetForwardingPipelineConfig(request)
 
+    def GetForwardingPipelineConfig(self, dry_run=False):
+        request = p4runtime_pb2.GetForwardingPipelineConfigRequest()
+        request.device_id = self.device_id
+        if dry_run:
+            print "P4Runtime GetForwardingPipelineConfig:", request
+        else:
+            return self.client_stub.GetForwardingPipelineConfig(request)
+
     def WriteMCastEntry(self, mcast_entry, dry_run=False):
         request = p4runtime_pb2.WriteRequest()
         request.device_id = self.device_id
@@ -101,6 +299,7 @@ class SwitchConnection(object):
         if dry_run:
             print "P4Runtime Write:", request
         else:
+            self.ensureMaster()
             self.client_stub.Write(request)
 
     def WriteTableEntry(self, table_entry, dry_run=False):
@@ -113,7 +312,56 @@ class SwitchConnection(object):
         if dry_run:
             print "P4Runtime Write:", request
         else:
+            self.ensureMaster()
+            self.client_stub.Write(request)
+
+    def SendWriteRequest(self, request, dry_run=False):
+        """
+        Sends a prepared WriteRequest to this switch. Returns the list of
+        (update, p4runtime_pb2.Error) pairs for the updates rejected by the
+        switch.
+        """
+        request.device_id = self.device_id
+        request.election_id.low = 1
+        if dry_run:
+            print "P4Runtime Write:", request
+            return []
+        self.ensureMaster()
+        try:
             self.client_stub.Write(request)
+        except grpc.RpcError as e:
+            errors = parseWriteErrors(e)
+            if errors is None:
+                raise
+            return [(update, error) for update, error in zip(request.updates, errors)
+                    if error.canonical_code != code_pb2.OK]
+        return []
+
+    def WriteUpdates(self, updates, batch_size=WRITE_BATCH_SIZE, dry_run=False):
+        """
+        Sends `updates` packed into WriteRequests of at most `batch_size`
+        updates each. Returns the updates rejected by the switch, as in
+        SendWriteRequest.
+        """
+        failures = []
+        for request in buildWriteRequests(updates, batch_size):
+            failures.extend(self.SendWriteRequest(request, dry_run))
+        return failures
+
+    def WriteMCastEntries(self, mcast_entries, update_type=p4runtime_pb2.Update.INSERT,
+                          batch_size=WRITE_BATCH_SIZE, dry_run=False):
+        updates = []
+        for mcast_entry in mcast_entries:
+            update = p4runtime_pb2.Update()
+            update.type = update_type
+            update.entity.packet_replication_engine_entry.CopyFrom(mcast_entry)
+            updates.append(update)
+        return self.WriteUpdates(updates, batch_size, dry_run)
+
+    def WriteTableEntries(self, table_entries, update_type=p4runtime_pb2.Update.INSERT,
+                          batch_size=WRITE_BATCH_SIZE, dry_run=False):
+        return self.WriteUpdates(buildTableUpdates(table_entries, update_type),
+                                 batch_size, dry_run)
 
     # This doesn't work because reading from the Packet Replication Engine (PRE)
     # is not implemented in P4 right now.
@@ -185,33 +433,48 @@ class SwitchConnection(object):
 
 class GrpcRequestLogger(grpc.UnaryUnaryClientInterceptor,
                         grpc.UnaryStreamClientInterceptor):
-    """Implementation of a gRPC interceptor that logs request to a file"""
-
-    def __init__(self, log_file):
-        self.log_file = log_file
-        with open(self.log_file, 'w') as f:
-            # Clear content if it exists.
-            f.write("")
-
-    def log_message(self, method_name, body):
-        with open(self.log_file, 'a') as f:
-            ts = datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S.%f')[:-3]
-            msg = str(body)
-            f.write("\n[%s] %s\n---\n" % (ts, method_name))
-            if len(msg) < MSG_LOG_MAX_LEN:
-                f.write(str(body))
-            else:
-                f.write("Message too long (%d bytes)! Skipping log...\n" % len(msg))
-            f.write('---\n')
+    """
+    Implementation of a gRPC interceptor that logs requests to a binary file,
+    see request_log.py. Only every `sample_every`-th request is logged, or
+    only the failed ones with `errors_only`. Failures of streaming calls
+    (Read) only show up while iterating, so they are not logged in that mode.
+    `methods` restricts logging to the given RPCs.
+    """
+
+    def __init__(self, log_file, sample_every=1, errors_only=False, methods=None):
+        if sample_every < 1:
+            raise ValueError("sample_every must be at least 1, got %r" % sample_every)
+        self.writer = RequestLogWriter(log_file)
+        self.sample_every = sample_every
+        self.errors_only = errors_only
+        self.methods = methods
+        self.count = 0
+
+    def sampled(self):
+        self.count += 1
+        return self.count % self.sample_every == 0
 
     def intercept_unary_unary(self, continuation, client_call_details, request):
-        self.log_message(client_call_details.method, request)
-        return continuation(client_call_details, request)
+        if self.methods is not None and client_call_details.method not in self.methods:
+            return continuation(client_call_details, request)
+        ts = time.time()
+        response = continuation(client_call_details, request)
+        failed = response.done() and response.exception() is not None
+        if failed or (not self.errors_only and self.sampled()):
+            self.writer.log(client_call_details.method, request.SerializeToString(),
+                            FLAG_ERROR if failed else 0, ts)
+        return response
 
     def intercept_unary_stream(self, continuation, client_call_details, request):
-        self.log_message(client_call_details.method, request)
+        if self.methods is not None and client_call_details.method not in self.methods:
+            return continuation(client_call_details, request)
+        if not self.errors_only and self.sampled():
+            self.writer.log(client_call_details.method, request.SerializeToString())
         return continuation(client_call_details, request)
 
+    def close(self):
+        self.writer.close()
+
 class IterableQueue(Queue):
     _sentinel = object()
 
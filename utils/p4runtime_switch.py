@@ -24,6 +24,10 @@ from mininet.log import info, error, debug
 from p4_mininet import P4Switch, SWITCH_START_TIMEOUT
 from netstat import check_listening_on_port
 
+# Port on which packets sent by the controller with PacketOut enter the switch.
+# Must match CPU_PORT in switch.p4.
+CPU_PORT = 255
+
 class P4RuntimeSwitch(P4Switch):
     "BMv2 switch with gRPC support"
     next_grpc_port = 50051
@@ -37,6 +41,7 @@ class P4RuntimeSwitch(P4Switch):
                  device_id = None,
                  enable_debugger = False,
                  log_file = None,
+                 cpu_port = CPU_PORT,
                  **kwargs):
         Switch.__init__(self, name, **kwargs)
         assert (sw_path)
@@ -75,6 +80,7 @@ class P4RuntimeSwitch(P4Switch):
             error('%s cannot bind port %d because it is bound by another process\n' % (self.name, self.grpc_port))
             exit(1)
 
+        self.cpu_port = cpu_port
         self.verbose = verbose
         logfile = "/tmp/p4s.{}.log".format(self.name)
         self.output = open(logfile, 'w')
@@ -126,6 +132,8 @@ class P4RuntimeSwitch(P4Switch):
             args.append('--thrift-port ' + str(self.thrift_port))
         if self.grpc_port:
             args.append("-- --grpc-server-addr 0.0.0.0:" + str(self.grpc_port))
+            if self.cpu_port is not None:
+                args.append("--cpu-port " + str(self.cpu_port))
         cmd = ' '.join(args)
         info(cmd + "\n")
 
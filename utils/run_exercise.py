@@ -19,7 +19,7 @@
 # We encourage you to dissect this script to better understand the BMv2/Mininet
 # environment used by the P4 tutorial.
 #
-import os, sys, json, subprocess, re, argparse
+import os, sys, json, subprocess, re, argparse, socket, struct
 from time import sleep
 
 from p4_mininet import P4Switch, P4Host
@@ -64,16 +64,35 @@ def configureP4Switch(**switch_args):
         return ConfiguredP4Switch
 
 
+def ip_to_int(ip):
+    return struct.unpack("!I", socket.inet_aton(ip))[0]
+
+def int_to_ip(n):
+    return socket.inet_ntoa(struct.pack("!I", n))
+
 class ExerciseTopo(Topo):
     """ The mininet topology class for the P4 tutorial exercises.
         A custom class is used because the exercises make a few topology
         assumptions, mostly about the IP and MAC addresses.
+
+        Each switch of the topology file can give its "tier" (1 for ToRs,
+        growing towards the core) and "role" ("tor" for switches with
+        hosts), and a ToR its "subnet" (e.g. "10.1.0.0/24"). The topology
+        can also carry an "addressing" plan, {"base": ip, "prefix_len": n},
+        from which ToRs without a subnet get consecutive ones. Without them,
+        the tier is the first digit of the switch number, ToRs are the switches
+        with hosts and hosts get 10.0.<switch number>.<host number>/24.
     """
-    def __init__(self, hosts, switches, links, log_dir, **opts):
+    def __init__(self, hosts, switches, links, log_dir, addressing=None, **opts):
         Topo.__init__(self, **opts)
         host_links = []
         switch_links = []
         self.sw_port_mapping = {}
+        # Also accept a plain list of switch names.
+        if not isinstance(switches, dict):
+            switches = dict((sw, {}) for sw in switches)
+        self.sw_info = switches
+        self.host_gateway = {}
 
         for link in links:
             if link['node1'][0] == 'h':
@@ -89,16 +108,32 @@ class ExerciseTopo(Topo):
         for sw in switches:
             self.addSwitch(sw, log_file="%s/%s.log" %(log_dir, sw))
 
+        self.host_switches = set(link['node2'] for link in host_links)
+        subnets = self.torSubnets(addressing)
+        hosts_on_switch = {}
         for link in host_links:
             host_name = link['node1']
             host_sw   = link['node2']
-            host_num = int(host_name[1:])
-            sw_num   = int(host_sw[1:])
-            host_ip = "10.0.%d.%d" % (sw_num, host_num)
-            host_mac = '00:00:00:00:%02x:%02x' % (sw_num, host_num)
-            # Each host IP should be /24, so all exercise traffic will use the
-            # default gateway (the switch) without sending ARP requests.
-            self.addHost(host_name, ip=host_ip+'/24', mac=host_mac)
+            if host_sw in subnets:
+                network, prefix_len = subnets[host_sw]
+                host_index = hosts_on_switch[host_sw] = hosts_on_switch.get(host_sw, 0) + 1
+                if host_index >= (1 << (32 - prefix_len)) - 2:
+                    raise Exception("Subnet of %s is too small for its hosts" % host_sw)
+                host_ip = int_to_ip(network + host_index)
+                host_mac = '00:00:' + ':'.join('%02x' % ord(b) for b in socket.inet_aton(host_ip))
+                # The last address of the subnet stands for the switch.
+                self.host_gateway[host_name] = int_to_ip(network + (1 << (32 - prefix_len)) - 2)
+            else:
+                host_num = int(host_name[1:])
+                sw_num   = int(host_sw[1:])
+                host_ip = "10.0.%d.%d" % (sw_num, host_num)
+                host_mac = '00:00:00:00:%02x:%02x' % (sw_num, host_num)
+                prefix_len = 24
+                self.host_gateway[host_name] = '10.0.%d.254' % host_num
+            # Each host IP should be in the subnet of its ToR, so all exercise
+            # traffic will use the default gateway (the switch) without sending
+            # ARP requests.
+            self.addHost(host_name, ip='%s/%d' % (host_ip, prefix_len), mac=host_mac)
             self.addLink(host_name, host_sw,
                          delay=link['latency'], bw=link['bandwidth'],
                          addr1=host_mac, addr2=host_mac)
@@ -112,6 +147,42 @@ class ExerciseTopo(Topo):
 
         self.printPortMapping()
 
+    def torSubnets(self, addressing):
+        """ Returns the subnet of each ToR as (network, prefix length), from
+            the "subnet" of the switch or the addressing plan.
+        """
+        subnets = {}
+        for sw in self.tors():
+            if 'subnet' in self.sw_info[sw]:
+                network, prefix_len = self.sw_info[sw]['subnet'].split('/')
+                subnets[sw] = (ip_to_int(network), int(prefix_len))
+        if addressing is not None:
+            prefix_len = addressing['prefix_len']
+            network = ip_to_int(addressing['base'])
+            for sw in self.tors():
+                if sw not in subnets:
+                    subnets[sw] = (network, prefix_len)
+                    network += 1 << (32 - prefix_len)
+        return subnets
+
+    def tier(self, sw):
+        """ Tier of a switch, 1 for ToRs. Hosts are at tier 0. """
+        if sw not in self.sw_info:
+            return 0
+        if 'tier' in self.sw_info[sw]:
+            return self.sw_info[sw]['tier']
+        return int(sw[1])
+
+    def isTor(self, sw):
+        if sw not in self.sw_info:
+            return False
+        if 'role' in self.sw_info[sw]:
+            return self.sw_info[sw]['role'] == 'tor'
+        return sw in self.host_switches
+
+    def tors(self):
+        return sorted(sw for sw in self.sw_info if self.isTor(sw))
+
     def addSwitchPort(self, sw, node2):
         if sw not in self.sw_port_mapping:
             self.sw_port_mapping[sw] = []
@@ -203,6 +274,7 @@ class ExerciseRunner:
         self.hosts = topo['hosts']
         self.switches = topo['switches']
         self.links = parse_links(topo['links'])
+        self.addressing = topo.get('addressing')
 
         # Ensure all the needed directories exist and are directories
         for dir_name in [log_dir, pcap_dir]:
@@ -246,7 +318,8 @@ class ExerciseRunner:
         """
         self.logger("Building mininet topology.")
 
-        self.topo = ExerciseTopo(self.hosts, self.switches.keys(), self.links, self.log_dir)
+        self.topo = ExerciseTopo(self.hosts, self.switches, self.links, self.log_dir,
+                                 self.addressing)
 
         switchClass = configureP4Switch(
                 sw_path=self.bmv2_exe,
@@ -270,7 +343,7 @@ class ExerciseRunner:
         runtime_json = sw_dict['runtime_json']
         self.logger('Configuring switch %s using P4Runtime with file %s' % (sw_name, runtime_json))
         with open(runtime_json, 'r') as sw_conf_file:
-            outfile = '%s/%s-p4runtime-requests.txt' %(self.log_dir, sw_name)
+            outfile = '%s/%s-p4runtime-requests.bin' %(self.log_dir, sw_name)
             p4runtime_lib.simple_controller.program_switch(
                 addr='127.0.0.1:%d' % grpc_port,
                 device_id=device_id,
@@ -320,8 +393,7 @@ class ExerciseRunner:
 
             sw_iface = link.intf1 if link.intf1 != h_iface else link.intf2
             # phony IP to lie to the host about
-            host_id = int(host_name[1:])
-            sw_ip = '10.0.%d.254' % host_id
+            sw_ip = self.topo.host_gateway[host_name]
 
             # Ensure each host's interface name is unique, or else
             # mininet cannot shutdown gracefully
@@ -368,8 +440,8 @@ class ExerciseRunner:
         print('')
         if 'grpc' in self.bmv2_exe:
             print('To view the P4Runtime requests sent to the switch, check the')
-            print('corresponding txt file in %s:' % self.log_dir)
-            print(' for example run:  cat %s/s1-p4runtime-requests.txt' % self.log_dir)
+            print('corresponding log file in %s:' % self.log_dir)
+            print(' for example run:  ./utils/p4runtime_lib/request_log.py %s/s1-p4runtime-requests.bin' % self.log_dir)
             print('')
 
         CLI(self.net)
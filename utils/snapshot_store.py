@@ -0,0 +1,226 @@
+#!/usr/bin/env python2
+#
+# Columnar store of the register snapshots taken by benchmark.py.
+#
+# Every register becomes a dense int64 array of shape (time, switch, index),
+# with -1 where a snapshot has no value. A store is either a single .npz file
+# or a directory of .npy files that can be memory-mapped. It holds:
+#
+#   switches        (S,)       switch names
+#   count           (T,)       snapshot numbers
+#   time            (T,)       snapshot start time, NaN if not recorded
+#   switch_time     (T, S)     start of the read of each switch, NaN if missing
+#   <register>      (T, S, I)  register values
+#   <register>.index (I,)      snapshot key of each index, e.g. '104' or '3'
+#
+# Convert a capture with
+#
+#   ./utils/snapshot_store.py data/data.json data/data.npz
+#   ./utils/snapshot_store.py capture.ndjson capture-store/
+#
+import argparse, json, os, struct
+import numpy as np
+
+# Snapshot fields that are not registers
+SNAPSHOT_FIELDS = ['count', 'times', 'start', 'end', 'skew']
+
+# Value of the slots a snapshot has no value for
+MISSING = -1
+
+# Bytes read at a time from JSON array captures
+READ_SIZE = 1 << 20
+
+def read_json_array(f):
+    """
+    Yields the elements of the JSON array `f` is positioned in, after the
+    opening bracket, without loading the whole array in memory.
+    """
+    decoder = json.JSONDecoder()
+    buf = ''
+    pos = 0
+    eof = False
+    while True:
+        while pos < len(buf) and buf[pos] in ' \t\r\n,':
+            pos += 1
+        if pos < len(buf) and buf[pos] == ']':
+            return
+        if pos < len(buf):
+            try:
+                element, pos = decoder.raw_decode(buf, pos)
+                yield element
+                continue
+            except ValueError:
+                # The element goes on past the end of the buffer.
+                if eof:
+                    raise
+        elif eof:
+            raise ValueError("Unterminated JSON array")
+        # Read at least as much as is buffered so that large elements are not
+        # decoded over and over.
+        more = f.read(max(READ_SIZE, len(buf) - pos))
+        eof = not more
+        buf = buf[pos:] + more
+        pos = 0
+
+def read_snapshots(path):
+    """
+    Yields the snapshots of a capture written by benchmark.py in any of its
+    formats: JSON array, NDJSON or length-prefixed JSON records. Only one
+    snapshot is held in memory at a time.
+    """
+    with open(path, 'rb') as f:
+        first = f.read(1)
+        while first.isspace():
+            first = f.read(1)
+        if first == '[':
+            for snapshot in read_json_array(f):
+                yield snapshot
+        elif first == '{':
+            f.seek(0)
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+        else:
+            f.seek(0)
+            while True:
+                header = f.read(4)
+                if len(header) < 4:
+                    return
+                length = struct.unpack('!I', header)[0]
+                yield json.loads(f.read(length))
+
+def index_sort_key(key):
+    return (0, int(key), key) if key.isdigit() else (1, 0, key)
+
+def scan(path):
+    """
+    First pass over a capture: returns the number of snapshots, the switches
+    and the sorted keys of each register.
+    """
+    num_snapshots = 0
+    switches = set()
+    keys = {}
+    for snapshot in read_snapshots(path):
+        num_snapshots += 1
+        for register_name, by_switch in snapshot.iteritems():
+            if register_name in SNAPSHOT_FIELDS:
+                continue
+            register_keys = keys.setdefault(register_name, set())
+            for switch, values in by_switch.iteritems():
+                switches.add(switch)
+                register_keys.update(values.keys())
+    return (num_snapshots, sorted(switches),
+            dict((r, sorted(k, key=index_sort_key)) for r, k in keys.iteritems()))
+
+def convert(capture_path, store_path):
+    """
+    Converts a capture to a store. `store_path` ending in .npz gives a single
+    compressed file, anything else a directory of .npy files written in place
+    through memory maps, so captures larger than memory can be converted.
+    """
+    num_snapshots, switches, keys = scan(capture_path)
+    in_directory = not store_path.endswith('.npz')
+    if in_directory and not os.path.isdir(store_path):
+        os.makedirs(store_path)
+
+    def new_array(name, shape, dtype, fill):
+        if in_directory:
+            array = np.lib.format.open_memmap(os.path.join(store_path, name + '.npy'),
+                                              mode='w+', dtype=dtype, shape=shape)
+        else:
+            array = np.empty(shape, dtype=dtype)
+        array.fill(fill)
+        return array
+
+    arrays = {
+        'switches': np.array(switches, dtype='S'),
+        'count': new_array('count', (num_snapshots,), np.int64, MISSING),
+        'time': new_array('time', (num_snapshots,), np.float64, np.nan),
+        'switch_time': new_array('switch_time', (num_snapshots, len(switches)),
+                                 np.float64, np.nan),
+    }
+    switch_pos = dict((sw, i) for i, sw in enumerate(switches))
+    key_pos = {}
+    for register_name, register_keys in keys.iteritems():
+        arrays[register_name] = new_array(
+            register_name, (num_snapshots, len(switches), len(register_keys)),
+            np.int64, MISSING)
+        arrays[register_name + '.index'] = np.array(register_keys, dtype='S')
+        key_pos[register_name] = dict((k, i) for i, k in enumerate(register_keys))
+
+    for t, snapshot in enumerate(read_snapshots(capture_path)):
+        arrays['count'][t] = snapshot.get('count', t)
+        if 'start' in snapshot:
+            arrays['time'][t] = snapshot['start']
+        for switch, times in snapshot.get('times', {}).iteritems():
+            if switch in switch_pos and 'start' in times:
+                arrays['switch_time'][t, switch_pos[switch]] = times['start']
+        for register_name, by_switch in snapshot.iteritems():
+            if register_name in SNAPSHOT_FIELDS:
+                continue
+            register = arrays[register_name]
+            positions = key_pos[register_name]
+            for switch, values in by_switch.iteritems():
+                s = switch_pos[switch]
+                for key, value in values.iteritems():
+                    register[t, s, positions[key]] = int(value)
+
+    if in_directory:
+        for name, array in arrays.iteritems():
+            if isinstance(array, np.memmap):
+                array.flush()
+            else:
+                np.save(os.path.join(store_path, name + '.npy'), array)
+    else:
+        np.savez_compressed(store_path, **arrays)
+    return num_snapshots
+
+class SnapshotStore(object):
+    """
+    Read access to a store. Arrays of a directory store are memory-mapped
+    unless `mmap` is False.
+    """
+
+    def __init__(self, path, mmap=True):
+        if os.path.isdir(path):
+            self.arrays = {}
+            for name in os.listdir(path):
+                if name.endswith('.npy'):
+                    self.arrays[name[:-4]] = np.load(os.path.join(path, name),
+                                                     mmap_mode='r' if mmap else None)
+        else:
+            self.arrays = np.load(path)
+        self.switches = [str(sw) for sw in self.arrays['switches']]
+        self.count = self.arrays['count']
+        self.time = self.arrays['time']
+        self.switch_time = self.arrays['switch_time']
+        self.switch_pos = dict((sw, i) for i, sw in enumerate(self.switches))
+
+    def registers(self):
+        return sorted(name for name in self.arrays.keys()
+                      if name + '.index' in self.arrays.keys())
+
+    def register(self, register_name):
+        """ Values of a register, shaped (time, switch, index). """
+        return self.arrays[register_name]
+
+    def index(self, register_name):
+        """ Snapshot key of each index of a register. """
+        return [str(key) for key in self.arrays[register_name + '.index']]
+
+    def series(self, register_name, switch, key):
+        """ Values of one slot of a register on one switch over time. """
+        position = self.index(register_name).index(str(key))
+        return self.register(register_name)[:, self.switch_pos[switch], position]
+
+def load(path, mmap=True):
+    return SnapshotStore(path, mmap)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Convert a benchmark.py capture '
+                                     'to a columnar NumPy store')
+    parser.add_argument('capture', help='Capture in JSON, NDJSON or binary format')
+    parser.add_argument('store', help='.npz file, or directory of .npy files')
+    args = parser.parse_args()
+    num_snapshots = convert(args.capture, args.store)
+    print "Converted %d snapshots to %s" % (num_snapshots, args.store)
@@ -1,9 +1,18 @@
-import sys, json, re, subprocess
+import os, sys, json, re, subprocess, time, grpc
+from multiprocessing.pool import ThreadPool
+from google.rpc import code_pb2
 import run_exercise
 import p4runtime_lib.bmv2
+from p4runtime_switch import CPU_PORT
 
 switch_reg = re.compile(r"^s(\d+)$")
 
+# Default number of switches operated on concurrently
+PROVISION_JOBS = 8
+# Upper bound on the time spent waiting for a pool of switch tasks. Waiting with
+# a timeout keeps the main thread responsive to KeyboardInterrupt.
+PROVISION_TIMEOUT = 3600
+
 def run_ssc_cmd(switch, cmd, debug=True):
     switch_port = 9090 + int(switch_reg.search(switch).group(1))
     cmd = "simple_switch_CLI --thrift-port %d <<EOF \n%s EOF" % (switch_port, cmd)
@@ -25,11 +34,102 @@ def printGrpcError(e):
     traceback = sys.exc_info()[2]
     print "[%s:%d]" % (traceback.tb_frame.f_code.co_filename, traceback.tb_lineno)
 
-def load_topology(topo_file_path):
+def printWriteErrors(switch, failures):
+    """
+    Helper function to print the updates rejected by a batched write
+
+    :param switch: the name of the switch the updates were sent to
+    :param failures: (update, error) pairs as returned by WriteUpdates
+    """
+
+    for update, error in failures:
+        print "%s: Write failed (%s): %s" % (switch,
+                                            code_pb2.Code.Name(error.canonical_code),
+                                            error.message)
+        print update
+
+def run_concurrently(switch_names, task, jobs=PROVISION_JOBS):
+    """
+    Helper function to run `task(switch_name)` for every switch on a pool of
+    threads. A failure on one switch does not stop the others.
+
+    :param switch_names: the switches to run the task on
+    :param task: a function taking a switch name
+    :param jobs: the maximum number of switches handled at the same time
+    :returns: dict from switch name to (elapsed seconds, error or None, result)
+    """
+
+    def timed(switch):
+        start = time.time()
+        try:
+            result = task(switch)
+        except grpc.RpcError as e:
+            return (switch, time.time() - start,
+                    "%s (%s)" % (e.details(), e.code().name), None)
+        except Exception as e:
+            return (switch, time.time() - start, repr(e), None)
+        return (switch, time.time() - start, None, result)
+
+    pool = ThreadPool(max(1, min(jobs, len(switch_names))))
+    try:
+        results = pool.map_async(timed, switch_names).get(PROVISION_TIMEOUT)
+    finally:
+        pool.terminate()
+    return dict((sw, (elapsed, error, result))
+                for (sw, elapsed, error, result) in results)
+
+def printSwitchReport(report):
+    """
+    Helper function to print the per-switch timings returned by run_concurrently
+
+    :param report: dict from switch name to (elapsed seconds, error, result)
+    """
+
+    failed = 0
+    for switch in sorted(report.keys()):
+        elapsed, error, _ = report[switch]
+        if error is None:
+            print "%s: done in %.3fs" % (switch, elapsed)
+        else:
+            failed += 1
+            print "%s: FAILED after %.3fs: %s" % (switch, elapsed, error)
+    print "%d/%d switches succeeded" % (len(report) - failed, len(report))
+
+def tor_switches(mn_topo):
+    """
+    Helper function to list the top of rack switches: the switches with the
+    "tor" role in the topology file, or else the switches with hosts attached
+    to them
+
+    :param mn_topo: the topology returned by load_topology
+    """
+
+    return mn_topo.tors()
+
+def tor_indices(mn_topo):
+    """
+    Helper function to number the top of rack switches from 0. The index of a
+    ToR is the id it has in the data plane: the index of its HULA registers
+    and the dst_tor of its probes.
+
+    :param mn_topo: the topology returned by load_topology
+    """
+
+    return dict((tor, i) for i, tor in enumerate(tor_switches(mn_topo)))
+
+def record_file(record_dir, switch):
+    return os.path.join(record_dir, "%s.bin" % switch)
+
+def load_topology(topo_file_path, record_dir=None, **log_options):
     """
-    Helper function to load a topology
+    Helper function to load a topology. The returned switch connections only
+    connect to their switch when first used.
 
     :param topo_file_path: the path to the JSON file containing the topology
+    :param record_dir: if set, the requests that program each switch are
+                       recorded to <record_dir>/<switch>.bin for replay.py
+    :param log_options: log_sample_every and log_errors_only, passed to the
+                        request logger of each connection
     """
 
     switch_number = 0
@@ -37,16 +137,19 @@ def load_topology(topo_file_path):
     with open(topo_file_path) as topo_data:
         j = json.load(topo_data)
     json_hosts = j['hosts']
-    json_switches = j['switches'].keys()
+    json_switches = j['switches']
     json_links = run_exercise.parse_links(j['links'])
-    mn_topo = run_exercise.ExerciseTopo(json_hosts, json_switches, json_links, "logs")
+    mn_topo = run_exercise.ExerciseTopo(json_hosts, json_switches, json_links, "logs",
+                                        j.get('addressing'))
     for switch in mn_topo.switches():
         switch_number += 1
         bmv2_switch = p4runtime_lib.bmv2.Bmv2SwitchConnection(
             name=switch,
             address="127.0.0.1:%d" % (50050 + switch_number),
             device_id=(switch_number - 1),
-            proto_dump_file="logs/%s-p4runtime-requests.txt" % switch)
+            proto_dump_file="logs/%s-p4runtime-requests.bin" % switch,
+            record_file=record_file(record_dir, switch) if record_dir else None,
+            **log_options)
         switches[switch] = bmv2_switch
 
     return (switches, mn_topo)
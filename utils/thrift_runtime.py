@@ -0,0 +1,133 @@
+import re, threading
+
+from thrift.transport import TSocket, TTransport
+from thrift.protocol import TBinaryProtocol, TMultiplexedProtocol
+from bm_runtime.standard import Standard
+from bm_runtime.simple_pre_lag import SimplePreLAG
+
+switch_reg = re.compile(r"^s(\d+)$")
+
+# Long-lived runtime clients, one per switch
+clients = {}
+clients_lock = threading.Lock()
+
+def thrift_port(switch):
+    """
+    Helper function to compute the thrift port of a switch. Matches the port
+    assigned by P4RuntimeSwitch.
+
+    :param switch: the name of the switch, of the form 's\d+'
+    """
+
+    return 9090 + int(switch_reg.search(switch).group(1))
+
+def ports_to_port_map(ports):
+    """
+    Helper function to build the port map string expected by the PRE, where
+    the i-th character from the right is '1' if port i is a member.
+
+    :param ports: list of port numbers
+    """
+
+    port_map = ['0'] * (max(ports) + 1 if ports else 0)
+    for port in ports:
+        port_map[port] = '1'
+    return ''.join(reversed(port_map))
+
+def GetThriftClient(switch):
+    """
+    Helper function to get the shared runtime client of a switch, connecting
+    to it on first use.
+
+    :param switch: the name of the switch
+    """
+
+    with clients_lock:
+        if switch not in clients:
+            clients[switch] = ThriftRuntimeClient(switch)
+        return clients[switch]
+
+def DropThriftClient(switch):
+    """
+    Helper function to close the client of a switch, e.g. after the switch
+    restarted. The next GetThriftClient reconnects.
+    """
+
+    with clients_lock:
+        client = clients.pop(switch, None)
+    if client is not None:
+        client.shutdown()
+
+def ShutdownAllThriftClients():
+    with clients_lock:
+        for c in clients.values():
+            c.shutdown()
+        clients.clear()
+
+class ThriftRuntimeClient(object):
+    """
+    Persistent connection to the thrift runtime server of a bmv2 switch. This
+    exposes the operations we used to run through simple_switch_CLI.
+    """
+
+    def __init__(self, name, address='127.0.0.1', port=None):
+        self.name = name
+        self.address = address
+        self.port = port if port is not None else thrift_port(name)
+        self.transport = TTransport.TBufferedTransport(
+            TSocket.TSocket(self.address, self.port))
+        protocol = TBinaryProtocol.TBinaryProtocol(self.transport)
+        self.standard = Standard.Client(
+            TMultiplexedProtocol.TMultiplexedProtocol(protocol, "standard"))
+        self.pre = SimplePreLAG.Client(
+            TMultiplexedProtocol.TMultiplexedProtocol(protocol, "simple_pre_lag"))
+        # Thrift clients are not thread safe.
+        self.lock = threading.Lock()
+        self.transport.open()
+
+    def shutdown(self):
+        self.transport.close()
+
+    def mc_mgrp_create(self, mgrp):
+        with self.lock:
+            return self.pre.bm_mc_mgrp_create(0, mgrp)
+
+    def mc_node_create(self, rid, ports):
+        with self.lock:
+            return self.pre.bm_mc_node_create(0, rid, ports_to_port_map(ports), "")
+
+    def mc_node_associate(self, mgrp_handle, node_handle):
+        with self.lock:
+            self.pre.bm_mc_node_associate(0, mgrp_handle, node_handle)
+
+    def mc_group_create(self, mgrp, ports):
+        """
+        Creates multicast group `mgrp` replicating to `ports` through a single
+        node. Returns the (group handle, node handle) pair.
+        """
+
+        mgrp_handle = self.mc_mgrp_create(mgrp)
+        node_handle = self.mc_node_create(0, ports)
+        self.mc_node_associate(mgrp_handle, node_handle)
+        return (mgrp_handle, node_handle)
+
+    def register_read(self, register_name, index):
+        with self.lock:
+            return self.standard.bm_register_read(0, register_name, index)
+
+    def register_write(self, register_name, index, value):
+        with self.lock:
+            self.standard.bm_register_write(0, register_name, index, value)
+
+    def register_read_all(self, register_name):
+        with self.lock:
+            return self.standard.bm_register_read_all(0, register_name)
+
+    def register_write_range(self, register_name, start, end, value):
+        """
+        Writes `value` at every index of `register_name` from `start` to `end`,
+        both included.
+        """
+
+        with self.lock:
+            self.standard.bm_register_write_range(0, register_name, start, end, value)